@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of ChecksummingSink computing crc32c, sha1, sha256 and s3_etag on one thread, and with
+parallel=True, for a range of write sizes.
+
+    python benchmarks/checksumming_parallel.py --size 1073741824 --chunk-sizes 65536 1048576 8388608 67108864
+"""
+
+import os, sys, argparse, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dcplib import s3_multipart  # noqa
+from dcplib.checksumming_io import ChecksummingSink  # noqa
+
+
+def measure(data, size, chunk_size, parallel):
+    view = memoryview(data)
+    start = time.perf_counter()
+    with ChecksummingSink(s3_multipart.get_s3_multipart_chunk_size(size), parallel=parallel) as sink:
+        written = 0
+        while written < size:
+            offset = written % len(data)
+            chunk = view[offset:offset + min(chunk_size, size - written, len(data) - offset)]
+            sink.write(chunk)
+            written += len(chunk)
+        checksums = sink.get_checksums()
+    return time.perf_counter() - start, checksums
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024 * 1024 * 1024)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[64 * 1024, 1024 * 1024, 8 * 1024 * 1024,
+                                                                       64 * 1024 * 1024])
+    args = parser.parse_args()
+
+    # The input repeats a block of random data, so that the benchmark does not need memory for all of it.
+    data = os.urandom(min(args.size, 64 * 1024 * 1024))
+    for chunk_size in args.chunk_sizes:
+        serial_elapsed, serial_checksums = measure(data, args.size, chunk_size, parallel=False)
+        parallel_elapsed, parallel_checksums = measure(data, args.size, chunk_size, parallel=True)
+        assert serial_checksums == parallel_checksums
+        print("{:>10} byte writes: serial {:7.1f} MiB/s, parallel {:7.1f} MiB/s ({:.2f}x)".format(
+            chunk_size, args.size / serial_elapsed / 2 ** 20, args.size / parallel_elapsed / 2 ** 20,
+            serial_elapsed / parallel_elapsed))
+
+
+if __name__ == "__main__":
+    main()
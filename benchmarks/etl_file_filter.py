@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Measures the per-file cost of DSSExtractor._should_fetch_file() on a synthetic set of manifest entries, compared with
+matching each pattern with fnmatch.fnmatchcase().
+
+    python benchmarks/etl_file_filter.py --files 1000000
+"""
+
+import os, sys, argparse, random, tempfile, time
+from fnmatch import fnmatchcase
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dcplib.etl import DSSExtractor  # noqa
+
+content_types = ['application/json; dcp-type="metadata/{}"'.format(t)
+                 for t in ("biomaterial", "file", "process", "protocol", "project", "links")]
+content_types += ['application/json; dcp-type="data"', "application/gzip", "application/octet-stream"]
+extensions = [".json", ".fastq.gz", ".bam", ".loom", ".csv", ".txt"]
+
+
+def synthetic_files(count, seed=0):
+    rng = random.Random(seed)
+    names = ["file_{}{}".format(i, rng.choice(extensions)) for i in range(1000)]
+    return [{"content-type": rng.choice(content_types), "name": rng.choice(names)} for _ in range(count)]
+
+
+def baseline_should_fetch_file(extractor, f):
+    if any(fnmatchcase(f["content-type"], p) for p in extractor.content_type_patterns):
+        return True
+    if any(fnmatchcase(f["name"], p) for p in extractor.filename_patterns):
+        return True
+    return False
+
+
+def measure(fn, files):
+    start = time.perf_counter()
+    matches = sum(1 for f in files if fn(f))
+    return time.perf_counter() - start, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--filename-patterns", nargs="*", default=["*.loom", "*.csv", "*_summary.txt"])
+    args = parser.parse_args()
+
+    files = synthetic_files(args.files)
+    with tempfile.TemporaryDirectory() as td:
+        extractor = DSSExtractor(staging_directory=td, filename_patterns=args.filename_patterns)
+        results = [
+            ("fnmatchcase", measure(lambda f: baseline_should_fetch_file(extractor, f), files)),
+            ("compiled", measure(extractor._should_fetch_file, files)),
+        ]
+    for name, (elapsed, matches) in results:
+        print("{:<12} {:8.3f}s {:8.0f}ns/file {} matches".format(name, elapsed, elapsed / len(files) * 1e9, matches))
+    assert len({matches for _, (_, matches) in results}) == 1
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
 from .checksumming_buffered_reader import ChecksummingBufferedReader
 from .checksumming_sink import ChecksummingSink
-from .s3_etag import S3Etag
+from .s3_etag import S3Etag, compute_s3_etag
+from .checksumming_tree import checksum_tree
@@ -5,6 +5,7 @@ import sys
 
 logger = logging.getLogger(__name__)
 PYTHON_VERSION_CUTOFF = '3.5'
+CRC32C_POLYNOMIAL = 0x82F63B78
 
 
 class CRC32C:
@@ -21,6 +22,21 @@ class CRC32C:
     def update(self, data):
         self._checksum_value = self._crc32c(data, self._checksum_value)
 
+    def combine(self, crc, length):
+        """
+        Extends the checksum as if the length bytes whose CRC32C is crc had been passed to update().
+        """
+        self._checksum_value = crc32c_combine(self._checksum_value, crc, length)
+
+    def get_state(self):
+        return dict(crc=self._checksum_value)
+
+    @classmethod
+    def from_state(cls, state):
+        crc32c = cls()
+        crc32c._checksum_value = state['crc']
+        return crc32c
+
     def hexdigest(self):
         _checksum_byte_value = self._long_to_bytes(self._checksum_value)
         if sys.version < PYTHON_VERSION_CUTOFF:
@@ -49,3 +65,48 @@ class CRC32C:
         _byte_string = _byte_string[i:]
 
         return _byte_string
+
+
+def _gf2_matrix_times(matrix, vector):
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def crc32c_combine(crc1, crc2, length2):
+    """
+    Returns the CRC32C of the concatenation of two blocks of data, given the CRC32C of each block and the length of
+    the second, so that the CRC32C of a file can be computed from parts checksummed in parallel. As in zlib's
+    crc32_combine(), crc1 is multiplied by the GF(2) matrix that appends length2 zero bytes, built by repeated
+    squaring in O(log(length2)) steps.
+    """
+    if length2 <= 0:
+        return crc1
+    # The operator that appends one zero bit, followed by those that append two and four zero bits
+    odd = [CRC32C_POLYNOMIAL] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    # Apply the operators for each set bit of length2, starting with the one that appends one zero byte
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
@@ -2,6 +2,7 @@ import hashlib
 from io import BufferedReader
 
 from ._crc32c import CRC32C
+from .parallel_hasher import ParallelHasher
 from .s3_etag import S3Etag
 
 
@@ -11,22 +12,29 @@ class ChecksummingBufferedReader:
         """
         :param file_handler: the file handler to read from
         :param read_file_size: file size for correctly setting the s3 etag chunk size
+        :param parallel: if True, compute the checksums on one thread per hash function
         """
+        parallel = kwargs.pop('parallel', False)
         self._hashers = dict(crc32c=CRC32C(),
                              sha1=hashlib.sha1(),
                              sha256=hashlib.sha256(),
                              s3_etag=S3Etag(read_chunk_size))
+        self._parallel_hasher = ParallelHasher(self._hashers) if parallel else None
         self._reader = BufferedReader(file_handler, *args, **kwargs)
         self.raw = self._reader.raw
 
     def read(self, size=None):
         chunk = self._reader.read(size)
-        if chunk:
+        if chunk and self._parallel_hasher is not None:
+            self._parallel_hasher.update(chunk)
+        elif chunk:
             for hasher in self._hashers.values():
                 hasher.update(chunk)
         return chunk
 
     def get_checksums(self):
+        if self._parallel_hasher is not None:
+            return self._parallel_hasher.hexdigests()
         checksums = {}
         checksums.update({name: hasher.hexdigest() for name, hasher in self._hashers.items()})
         return checksums
@@ -35,4 +43,6 @@ class ChecksummingBufferedReader:
         return self
 
     def __exit__(self, *args, **kwargs):
+        if self._parallel_hasher is not None:
+            self._parallel_hasher.close()
         self._reader.close()
@@ -1,16 +1,23 @@
 import hashlib
 
 from ._crc32c import CRC32C
+from .parallel_hasher import ParallelHasher
 from .s3_etag import S3Etag
 
 """
 A file-like object that computes checksums for the data written to it, discarding the actual data. Current accepted
-checksum functions are crc32c, s3_etag, sha1, and sha256.
+checksum functions are crc32c, s3_etag, sha1, and sha256. With parallel=True, the checksums are computed on one
+thread per hash function.
+
+checkpoint() saves the partial state of the checksums, from which resume() creates a sink that continues where the
+checkpoint was taken. hashlib cannot save the internal state of sha1 and sha256, so each checksum resumes from the
+furthest offset it can: crc32c from the checkpoint, s3_etag from the end of its last finished part, and sha1 and
+sha256 from the start. The data must be written to the resumed sink from its offset.
 """
 
 
 class ChecksummingSink:
-    def __init__(self, write_chunk_size, hash_functions=('crc32c', 'sha1', 'sha256', 's3_etag')):
+    def __init__(self, write_chunk_size, hash_functions=('crc32c', 'sha1', 'sha256', 's3_etag'), parallel=False):
         """ ChecksummingSink is initialized with a map from the name of the hash function to an object that
         represents the calculation function."""
         self._hashers = dict()
@@ -23,18 +30,88 @@ class ChecksummingSink:
                 self._hashers['sha256'] = hashlib.sha256()
             elif hasher == 's3_etag':
                 self._hashers['s3_etag'] = S3Etag(write_chunk_size)
+        self._write_chunk_size = write_chunk_size
+        self._parallel_hasher = ParallelHasher(self._hashers) if parallel and len(self._hashers) > 1 else None
+        self._offset = 0
+        # The offsets up to which resumed hashers have already hashed the data
+        self._resume_offsets = {}
+
+    @property
+    def offset(self):
+        """
+        The number of bytes of data before the next write.
+        """
+        return self._offset
 
     def write(self, data):
+        start = self._offset
+        self._offset += len(data)
+        if self._resume_offsets:
+            self._write_resumed(data, start)
+            return
+        if self._parallel_hasher is not None:
+            self._parallel_hasher.update(data)
+            return
         for hasher in self._hashers.values():
             hasher.update(data)
 
+    def _write_resumed(self, data, start):
+        view = memoryview(data).cast('B')
+        for name, hasher in self._hashers.items():
+            skip = self._resume_offsets.get(name, 0) - start
+            if skip < len(view):
+                hasher.update(view[max(skip, 0):])
+        self._resume_offsets = {name: offset for name, offset in self._resume_offsets.items()
+                                if offset > self._offset}
+
+    def checkpoint(self):
+        """
+        Returns a JSON-serializable checkpoint of the checksums of the data written so far.
+        """
+        if self._parallel_hasher is not None:
+            self._parallel_hasher.flush()
+        hashers = {}
+        for name, hasher in self._hashers.items():
+            # A resumed hasher may already have hashed data beyond the offset of the sink.
+            resume_offset = self._resume_offsets.get(name, 0)
+            if name == 'crc32c':
+                hashers[name] = dict(hasher.get_state(), offset=max(self._offset, resume_offset))
+            elif name == 's3_etag':
+                hashers[name] = dict(hasher.get_state(), offset=max(hasher.resume_offset, resume_offset))
+            else:
+                hashers[name] = dict(offset=0)
+        return dict(write_chunk_size=self._write_chunk_size, hashers=hashers)
+
+    @classmethod
+    def resume(cls, checkpoint, parallel=False):
+        """
+        Returns a sink that continues computing the checksums saved by checkpoint(). Its offset is the position in the
+        data from which writes must continue; data that a checksum has already been computed over is not hashed again.
+        """
+        sink = cls(checkpoint['write_chunk_size'], hash_functions=tuple(checkpoint['hashers']), parallel=parallel)
+        for name, state in checkpoint['hashers'].items():
+            if name == 'crc32c':
+                sink._hashers[name] = CRC32C.from_state(state)
+            elif name == 's3_etag':
+                sink._hashers[name] = S3Etag.from_state(state)
+        sink._offset = min((state['offset'] for state in checkpoint['hashers'].values()), default=0)
+        sink._resume_offsets = {name: state['offset'] for name, state in checkpoint['hashers'].items()
+                                if state['offset'] > sink._offset}
+        return sink
+
     def get_checksums(self):
+        if self._parallel_hasher is not None:
+            return self._parallel_hasher.hexdigests()
         checksums = {}
         checksums.update({name: hasher.hexdigest() for name, hasher in self._hashers.items()})
         return checksums
 
+    def close(self):
+        if self._parallel_hasher is not None:
+            self._parallel_hasher.close()
+
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        pass
+        self.close()
@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ..s3_multipart import get_s3_multipart_chunk_size
+from .checksumming_sink import ChecksummingSink
+
+"""
+Checksums every file under a directory, skipping files whose checksums are already in a persistent cache. A cached
+checksum is used as long as the path, size, modification time and inode of the file are unchanged, so that scanning a
+tree again only costs a stat per unchanged file.
+"""
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'dcplib', 'checksums.sqlite')
+
+
+class ChecksumCache:
+    """
+    Several scans can share a cache: puts are buffered until commit(), which writes them in one short transaction, and
+    the database is in WAL mode, so that readers do not wait for writers.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                        "inode INTEGER, checksums TEXT)")
+        self._pending = {}
+
+    def get(self, path, stat, hash_functions):
+        """
+        Returns the cached checksums of the file at path, if the file is unchanged and all of hash_functions are cached.
+        """
+        row = self.db.execute("SELECT checksums FROM checksums WHERE path=? AND size=? AND mtime_ns=? AND inode=?",
+                              (path, stat.st_size, stat.st_mtime_ns, stat.st_ino)).fetchone()
+        if row is None:
+            return None
+        checksums = json.loads(row[0])
+        if not all(name in checksums for name in hash_functions):
+            return None
+        return {name: checksums[name] for name in hash_functions}
+
+    def put(self, path, stat, checksums):
+        self._pending[path] = (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, json.dumps(checksums))
+
+    def commit(self):
+        if not self._pending:
+            return
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)", self._pending.values())
+        self._pending.clear()
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            self.db.close()
+
+
+def checksum_file(path, hash_functions=('crc32c', 'sha1', 'sha256', 's3_etag'), read_chunk_size=8 * 1024 * 1024):
+    """
+    Returns the checksums of a file, reading it read_chunk_size bytes at a time.
+    """
+    with open(path, 'rb') as fh:
+        sink = ChecksummingSink(get_s3_multipart_chunk_size(os.fstat(fh.fileno()).st_size),
+                                hash_functions=hash_functions)
+        while True:
+            chunk = fh.read(read_chunk_size)
+            if not chunk:
+                break
+            sink.write(chunk)
+    return sink.get_checksums()
+
+
+def _cache_key(stat):
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def _walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+
+
+def checksum_tree(root, hash_functions=('crc32c', 'sha1', 'sha256', 's3_etag'), workers=None, cache_path=None,
+                  read_chunk_size=8 * 1024 * 1024, commit_interval=1000):
+    """
+    Yields a (path, checksums) pair for every file under root, as it is checksummed or found in the cache. Files are
+    checksummed on up to workers threads, each holding one chunk of read_chunk_size bytes, and at most two files per
+    worker are queued at a time, so that memory use does not grow with the size of the tree. Cached results are yielded
+    as they are found, and others as they complete, so results are not in any particular order.
+    :param root: the directory to walk
+    :param hash_functions: the checksums to compute, as accepted by ChecksummingSink
+    :param workers: the number of files to checksum at a time, by default the number of CPUs
+    :param cache_path: the SQLite database in which checksums are cached, by default DEFAULT_CACHE_PATH
+    """
+    hash_functions = tuple(hash_functions)
+    workers = workers or os.cpu_count()
+    cache = ChecksumCache(cache_path or DEFAULT_CACHE_PATH)
+    cache_files = {os.path.abspath(cache.path) + suffix for suffix in ('', '-journal', '-wal', '-shm')}
+    uncommitted = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Maps each pending future to the path and stat of the file it is checksumming
+            in_flight = {}
+
+            def finish(done):
+                nonlocal uncommitted
+                for future in done:
+                    path, stat = in_flight.pop(future)
+                    try:
+                        checksums = future.result()
+                        unchanged = _cache_key(os.stat(path)) == _cache_key(stat)
+                    except FileNotFoundError:
+                        # The file was removed while the tree was being scanned
+                        continue
+                    # Files that changed while they were read are checksummed again by the next scan
+                    if unchanged:
+                        cache.put(path, stat, checksums)
+                        uncommitted += 1
+                    if uncommitted >= commit_interval:
+                        cache.commit()
+                        uncommitted = 0
+                    yield path, checksums
+
+            for path in _walk_files(root):
+                path = os.path.abspath(path)
+                if path in cache_files:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                checksums = cache.get(path, stat, hash_functions)
+                if checksums is not None:
+                    yield path, checksums
+                    continue
+                if len(in_flight) >= 2 * workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    yield from finish(done)
+                future = executor.submit(checksum_file, path, hash_functions, read_chunk_size)
+                in_flight[future] = path, stat
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                yield from finish(done)
+    finally:
+        cache.close()
@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Updates several hashers with the same data in parallel, on one thread per hasher. hashlib and crc32c release the GIL
+while hashing large buffers, so the combined throughput approaches that of the slowest hash function rather than the
+sum of all of them.
+"""
+
+
+class ParallelHasher:
+
+    def __init__(self, hashers, min_chunk_size=1024 * 1024):
+        """
+        :param hashers: a map from the name of each hash function to an object with update() and hexdigest() methods
+        :param min_chunk_size: smaller writes are buffered until this many bytes are available, as handing a chunk
+                               to the worker threads costs more than hashing a few kilobytes
+        """
+        self._hashers = hashers
+        self._min_chunk_size = min_chunk_size
+        self._buffer = bytearray()
+        self._pending = []
+        self._executor = None
+
+    def update(self, data):
+        """
+        Hands data to the hashers and returns while they are hashing it, once they have finished with the previous
+        chunk, so that hashing overlaps with reading or writing the next chunk. Errors raised by a hasher are raised
+        by the following call to update() or hexdigests().
+        """
+        if self._buffer or len(data) < self._min_chunk_size:
+            self._buffer += data
+            if len(self._buffer) < self._min_chunk_size:
+                return
+            data, self._buffer = bytes(self._buffer), bytearray()
+        elif not isinstance(data, bytes):
+            # The caller may reuse its buffer as soon as we return.
+            data = bytes(data)
+        self._submit(data)
+
+    def _submit(self, data):
+        self._wait()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self._hashers))
+        self._pending = [self._executor.submit(hasher.update, data) for hasher in self._hashers.values()]
+
+    def _wait(self):
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def flush(self):
+        """
+        Waits until all data passed to update() has been hashed.
+        """
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            self._submit(data)
+        self._wait()
+
+    def hexdigests(self):
+        self.flush()
+        return {name: hasher.hexdigest() for name, hasher in self._hashers.items()}
+
+    def close(self):
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -1,8 +1,14 @@
 import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ..s3_multipart import get_s3_multipart_chunk_size
 
 """
 A digest generator that generates S3 ETAGs
-with the same interface as the hashlib generators.
+with the same interface as the hashlib generators, and compute_s3_etag(), which computes the S3 ETag of a local file
+by hashing its parts in parallel.
 """
 
 
@@ -19,24 +25,74 @@ class S3Etag:
         return self._chunk_size
 
     def update(self, chunk):
-        if self._etag_bytes + len(chunk) > self.chunk_size:
-            chunk_head = chunk[:self.chunk_size - self._etag_bytes]
-            chunk_tail = chunk[self.chunk_size - self._etag_bytes:]
-            self._etag_hasher.update(chunk_head)
-            self._etag_parts.append(self._etag_hasher.digest())
-            self._etag_hasher = hashlib.md5()
-            self._etag_hasher.update(chunk_tail)
-            self._etag_bytes = len(chunk_tail)
-        else:
-            self._etag_hasher.update(chunk)
-            self._etag_bytes += len(chunk)
+        # Parts are hashed through memoryview slices of the chunk, which do not copy it, and a part is only finished
+        # once more data arrives, as S3 does not start a new part for an upload that ends on a part boundary.
+        view = memoryview(chunk).cast("B")
+        offset = 0
+        while offset < len(view):
+            if self._etag_bytes == self.chunk_size:
+                self._etag_parts.append(self._etag_hasher.digest())
+                self._etag_hasher = hashlib.md5()
+                self._etag_bytes = 0
+            size = min(self.chunk_size - self._etag_bytes, len(view) - offset)
+            self._etag_hasher.update(view[offset:offset + size])
+            self._etag_bytes += size
+            offset += size
+
+    def get_state(self):
+        """
+        Returns the digests of the finished parts. Hashing can resume from the state, with from_state(), at the end
+        of the last finished part; the md5 of the current part cannot be saved.
+        """
+        return dict(chunk_size=self._chunk_size, parts=[part.hex() for part in self._etag_parts])
+
+    @classmethod
+    def from_state(cls, state):
+        etag = cls(state['chunk_size'])
+        etag._etag_parts = [bytes.fromhex(part) for part in state['parts']]
+        return etag
+
+    @property
+    def resume_offset(self):
+        """
+        The number of bytes hashed into the finished parts, from which hashing resumes after from_state().
+        """
+        return len(self._etag_parts) * self._chunk_size
 
     def hexdigest(self):
-        if self._etag_bytes:
-            self._etag_parts.append(self._etag_hasher.digest())
-            self._etag_bytes = 0
-        if len(self._etag_parts) > 1:
-            etag_csum = hashlib.md5(b"".join(self._etag_parts)).hexdigest()
-            return '{}-{}'.format(etag_csum, len(self._etag_parts))
+        parts = self._etag_parts + [self._etag_hasher.digest()] if self._etag_parts else []
+        if len(parts) > 1:
+            etag_csum = hashlib.md5(b"".join(parts)).hexdigest()
+            return '{}-{}'.format(etag_csum, len(parts))
         else:
             return self._etag_hasher.hexdigest()
+
+
+def _part_digest(path, offset, size):
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            return hashlib.md5(view[offset:offset + size]).digest()
+        finally:
+            view.release()
+
+
+def compute_s3_etag(path, workers=None, chunk_size=None, executor_class=ThreadPoolExecutor):
+    """
+    Computes the S3 ETag of a local file, hashing its parts on up to workers threads at a time. hashlib releases the
+    GIL while hashing, so threads scale with the number of cores; pass executor_class=ProcessPoolExecutor to use
+    processes instead. Each part is read from a memory map of the file, without copying it.
+    :param path: the file to compute the S3 ETag of
+    :param workers: the number of parts to hash at a time, by default the number of CPUs
+    :param chunk_size: the S3 multipart chunk size, by default as given by get_s3_multipart_chunk_size()
+    """
+    size = os.path.getsize(path)
+    chunk_size = chunk_size or get_s3_multipart_chunk_size(size)
+    if size == 0:
+        return hashlib.md5().hexdigest()
+    offsets = range(0, size, chunk_size)
+    with executor_class(max_workers=workers or os.cpu_count()) as executor:
+        digests = list(executor.map(_part_digest, [path] * len(offsets), offsets, [chunk_size] * len(offsets)))
+    if len(digests) == 1:
+        return digests[0].hex()
+    return '{}-{}'.format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
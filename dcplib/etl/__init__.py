@@ -17,23 +17,75 @@ Example usage:
     DSSExtractor(staging_directory=".").extract(transformer=tf, loader=ld, finalizer=fn)
 """
 
-import os, sys, json, concurrent.futures, hashlib, logging, threading, time, traceback, itertools
-from fnmatch import fnmatchcase
+import os, sys, json, concurrent.futures, logging, threading, time, itertools, collections, functools
+import contextlib, queue, urllib.parse, re
+from fnmatch import translate
 
 import hca
 from ..networking import HTTPRequest
+from ..checksumming_io import ChecksummingSink
+from .staging import StagingArea, ContentAddressedStagingArea
+from .stores import CheckpointJournal, ErrorStore
+from .metrics import ExtractionMetrics
+from .cache import StagingCache
+from .bundle_view import BundleView, DocumentCache
+from .concurrency import AdaptiveConcurrencyLimiter
 
 logger = logging.getLogger(__name__)
 
 def page_iterator(iterator, page_size):
     return iter(lambda: list(itertools.islice(iterator, page_size)), [])
 
+def in_shard(bundle_uuid, shard_index=0, shard_count=1):
+    """
+    Bundles are assigned to shards by the first two hex digits of their UUIDs, which are the prefixes used to list all
+    bundles, so that each shard lists and extracts a disjoint set of bundles.
+    """
+    return int(bundle_uuid[:2], 16) % shard_count == shard_index
+
+def compile_patterns(patterns):
+    """
+    Compiles a list of shell-style patterns into one regular expression, whose match() method matches a string
+    against any of the patterns with the same semantics as fnmatch.fnmatchcase().
+    """
+    if not patterns:
+        return re.compile("(?!)")
+    return re.compile("|".join(translate(p) for p in patterns))
+
+class ChecksumMismatch(Exception):
+    pass
+
+class DSSCheckoutError(Exception):
+    pass
+
+class _ListingStopped(Exception):
+    pass
+
+class _PageState:
+    def __init__(self):
+        self.results = []
+        self.pending = 0
+        self.dispatched = False
+
+    @property
+    def done(self):
+        return self.dispatched and self.pending == 0
+
 class DSSExtractor:
     default_content_type_patterns = ['application/json; dcp-type="metadata*"']
+    # How often, in seconds, the scheduler checks for newly listed bundles when it has room for more
+    listing_poll_interval = 0.1
+    # How often, and for how long, in seconds, to poll the status of a bundle checkout
+    checkout_poll_interval = 1
+    checkout_timeout = 600
 
     def __init__(self, staging_directory, content_type_patterns: list = None, filename_patterns: list = None,
                  dss_client: hca.dss.DSSClient = None, http_client: HTTPRequest = None,
-                 dispatch_on_empty_bundles=False, continue_on_bundle_extract_errors=False):
+                 dispatch_on_empty_bundles=False, continue_on_bundle_extract_errors=False,
+                 download_chunk_size=1024 * 1024, staging_area_class=StagingArea, max_file_fetch_workers=None,
+                 bundle_checkout=False, checkout_range_size=8 * 1024 * 1024, cache_max_bytes=None,
+                 cache_max_bundles=None, cache_policy=StagingCache.LRU, document_cache_size=1024,
+                 concurrency_limiter: AdaptiveConcurrencyLimiter = None):
         self.sd = staging_directory
         self.content_type_patterns = content_type_patterns or self.default_content_type_patterns
         self.filename_patterns = filename_patterns or []
@@ -43,7 +95,56 @@ class DSSExtractor:
         self._dispatch_on_empty_bundles = dispatch_on_empty_bundles
         self._continue_on_bundle_extract_errors = continue_on_bundle_extract_errors
         self._http = http_client or HTTPRequest()
-        os.makedirs(f"{self.sd}/errors", exist_ok=True)
+        # Files are streamed to disk in chunks of this many bytes, bounding the memory used by each worker.
+        self._download_chunk_size = download_chunk_size
+        # If set, the files of all bundles are fetched on one shared pool of this many threads, so that the files of
+        # a large bundle are fetched in parallel while the total number of concurrent file fetches stays bounded.
+        self._max_file_fetch_workers = max_file_fetch_workers
+        self._fetch_executor = None
+        self._fetch_executor_lock = threading.Lock()
+        # If set, bundles with files to fetch are checked out, and their files are fetched from the checkout location
+        # with GET requests of up to checkout_range_size bytes each, skipping the per-file /files redirect.
+        self._bundle_checkout = bundle_checkout
+        self._checkout_range_size = checkout_range_size
+        os.makedirs(self.sd, exist_ok=True)
+        self.staging = staging_area_class(self.sd, chunk_size=download_chunk_size)
+        self.journal = CheckpointJournal(self.staging.db_path)
+        self.errors = ErrorStore(self.staging.db_path)
+        self.metrics = ExtractionMetrics()
+        # If a budget is set, extract() evicts the least recently (or frequently) used bundles from the staging area
+        # to stay within it.
+        self.cache = None
+        if cache_max_bytes is not None or cache_max_bundles is not None:
+            self.cache = StagingCache(self.staging, max_bytes=cache_max_bytes, max_bundles=cache_max_bundles,
+                                      policy=cache_policy)
+        # Parsed JSON documents, shared by the bundle views of all bundles
+        self.document_cache = DocumentCache(max_entries=document_cache_size)
+        # If set, extract() adapts the number of bundles being fetched to the responses of the HTTP client.
+        self.concurrency_limiter = concurrency_limiter
+        if concurrency_limiter is not None:
+            if not isinstance(self._http, HTTPRequest):
+                raise TypeError("A concurrency limiter requires an HTTPRequest http_client")
+            self._http.response_hooks.append(concurrency_limiter.response_hook)
+            self._http.retry_hooks.append(concurrency_limiter.retry_hook)
+
+    # Patterns are compiled when they are set, as they are matched against every file in every manifest.
+    @property
+    def content_type_patterns(self):
+        return self._content_type_patterns
+
+    @content_type_patterns.setter
+    def content_type_patterns(self, patterns):
+        self._content_type_patterns = patterns
+        self._content_type_regex = compile_patterns(patterns)
+
+    @property
+    def filename_patterns(self):
+        return self._filename_patterns
+
+    @filename_patterns.setter
+    def filename_patterns(self, patterns):
+        self._filename_patterns = patterns
+        self._filename_regex = compile_patterns(patterns)
 
     # concurrent.futures.ProcessPoolExecutor requires objects to be picklable.
     # hca.dss.DSSClient is unpicklable and is stubbed out here to preserve DSSExtractor's picklability.
@@ -51,19 +152,76 @@ class DSSExtractor:
         state = dict(self.__dict__)
         state["_dss_swagger_url"] = self.dss_client.swagger_url
         state["_dss_client"] = None
+        state["_fetch_executor"] = None
+        del state["_fetch_executor_lock"]
         return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._fetch_executor_lock = threading.Lock()
+
     @property
     def dss_client(self):
         if self._dss_client is None:
             self._dss_client = self._dss_client_class(swagger_url=self._dss_swagger_url)
         return self._dss_client
 
+    @property
+    def fetch_executor(self):
+        """
+        The thread pool shared by all bundles for fetching files, or None if files are fetched by each bundle's worker.
+        Each process creates its own pool on first use.
+        """
+        if self._max_file_fetch_workers is not None and self._fetch_executor is None:
+            with self._fetch_executor_lock:
+                if self._fetch_executor is None:
+                    self._fetch_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self._max_file_fetch_workers, thread_name_prefix="fetch"
+                    )
+        return self._fetch_executor
+
+    def _shutdown_fetch_executor(self):
+        with self._fetch_executor_lock:
+            if self._fetch_executor is not None:
+                self._fetch_executor.shutdown()
+                self._fetch_executor = None
+
+    def bundle_view(self, bundle_uuid, bundle_version):
+        """
+        Returns a BundleView of the files staged for a bundle, giving transformers memory-mapped file contents and
+        cached JSON documents. See dcplib.etl.bundle_view.
+        """
+        return BundleView(self.staging.bundle_path(bundle_uuid, bundle_version),
+                          self.staging.load_manifest(bundle_uuid, bundle_version),
+                          document_cache=self.document_cache,
+                          file_paths=self.staging.staged_files(bundle_uuid, bundle_version))
+
     def extract_transform_one(self, bundle_uuid, bundle_version, transformer: callable = None):
+        bundle_uuid, bundle_version, fetched_files = self.extract_one(bundle_uuid, bundle_version)
+        return self.transform_one(bundle_uuid, bundle_version, transformer)
+
+    def extract_one(self, bundle_uuid, bundle_version):
+        if self.cache is not None:
+            self.cache.touch(bundle_uuid, bundle_version)
         bundle_uuid, bundle_version, fetched_files = self.get_files_to_fetch_for_bundle(bundle_uuid, bundle_version)
-        bundle_path = f"{self.sd}/bundles/{bundle_uuid}.{bundle_version}"
-        bundle_manifest_path = f"{self.sd}/bundle_manifests/{bundle_uuid}.{bundle_version}.json"
-        if not os.path.exists(bundle_path):
+        if self.cache is not None:
+            manifest_path = self.staging.manifest_path(bundle_uuid, bundle_version)
+            if manifest_path is not None:
+                self.cache.add_file(bundle_uuid, bundle_version, manifest_path)
+                self.cache.update_size(manifest_path)
+        self.journal.record(bundle_uuid, bundle_version, CheckpointJournal.EXTRACTED)
+        return bundle_uuid, bundle_version, fetched_files
+
+    def transform_one(self, bundle_uuid, bundle_version, transformer: callable = None):
+        with self.metrics.timer("transform"):
+            tb = self._transform_one(bundle_uuid, bundle_version, transformer)
+        self.journal.record(bundle_uuid, bundle_version, CheckpointJournal.TRANSFORMED)
+        return tb
+
+    def _transform_one(self, bundle_uuid, bundle_version, transformer: callable = None):
+        bundle_path = self.staging.bundle_path(bundle_uuid, bundle_version)
+        bundle_manifest_path = self.staging.manifest_path(bundle_uuid, bundle_version)
+        if not self.staging.is_staged(bundle_uuid, bundle_version):
             if self._dispatch_on_empty_bundles:
                 bundle_path = None
             else:
@@ -74,159 +232,869 @@ class DSSExtractor:
 
             return tb
 
-    def page_bundles(self, query=None, replica="aws", page_size=None):
-        if query is None:
-            yield from page_iterator(self.list_all_bundles(), page_size)
+    def page_bundles(self, query=None, replica="aws", page_size=None, incremental=False, shard_index=0,
+                     shard_count=1, bundles=None):
+        """
+        Yields pages of bundles to be extracted: the given list of bundles, the results of the query, or all listed
+        bundles. Listed bundles are limited to the given shard; search results and given bundles are not, and are
+        filtered by the caller.
+        """
+        if bundles is not None:
+            yield from page_iterator(iter(bundles), page_size)
+        elif query is None:
+            bundles = self.list_all_bundles(incremental=incremental, shard_index=shard_index, shard_count=shard_count)
+            yield from page_iterator(bundles, page_size)
         else:
             yield from self.dss_client.post_search.paginate(es_query=query, replica=replica, per_page=page_size)
 
-    def list_all_bundles(self):
-        for bundle_list_file in os.listdir(f"{self.sd}/bundle_list"):
-            with open(f"{self.sd}/bundle_list/{bundle_list_file}") as fh:
-                for line in fh:
-                    yield json.loads(line)
+    def list_all_bundles(self, incremental=False, shard_index=0, shard_count=1):
+        """
+        Yields the bundles listed by get_list_of_all_bundles(). If incremental is True, only yields the bundles that
+        were not present in the previous listing.
+        """
+        dirname = "bundle_list_new" if incremental else "bundle_list"
+        yield from self._read_bundle_lists(dirname, shard_index, shard_count)
+
+    def list_deleted_bundles(self, shard_index=0, shard_count=1):
+        """
+        Yields the bundles that were present in the previous listing but not in the latest incremental listing.
+        """
+        yield from self._read_bundle_lists("bundle_list_deleted", shard_index, shard_count)
+
+    def _read_bundle_lists(self, dirname, shard_index=0, shard_count=1):
+        prefixes = {bundle_list_file.split(".", 1)[0] for bundle_list_file in os.listdir(f"{self.sd}/{dirname}")
+                    if bundle_list_file.endswith((".jsonl", ".jsonl.next"))}
+        for prefix in sorted(prefixes):
+            if in_shard(prefix, shard_index, shard_count):
+                yield from self._read_bundle_list(dirname, prefix)
+
+    def _read_bundle_list(self, dirname, prefix):
+        """
+        Yields the bundles in a listing. The full listing of the current extraction, bundle_list/<prefix>.jsonl.next,
+        is read if it exists, and otherwise the listing left by the previous extraction.
+        """
+        bundle_list_path = f"{self.sd}/{dirname}/{prefix}.jsonl"
+        if os.path.exists(f"{bundle_list_path}.next"):
+            bundle_list_path = f"{bundle_list_path}.next"
+        with open(bundle_list_path) as fh:
+            for line in fh:
+                yield json.loads(line)
 
-    def get_list_of_all_bundles(self, prefix):
+    def _promote_bundle_lists(self, incremental=False, shard_index=0, shard_count=1):
+        """
+        Replaces the listings left by the previous extraction with those of the extraction that just completed, which
+        become the baseline for the next incremental extraction. Bundles that were dispatched but not loaded are left
+        out, so that they are new to the next incremental extraction and are dispatched again.
+        """
+        for bundle_list_file in sorted(os.listdir(f"{self.sd}/bundle_list")):
+            prefix = bundle_list_file[:-len(".jsonl.next")]
+            if not bundle_list_file.endswith(".jsonl.next") or not in_shard(prefix, shard_index, shard_count):
+                continue
+            dispatched = self._read_bundle_list("bundle_list_new", prefix) if incremental else ()
+            unloaded = {(bundle["uuid"], bundle["version"]) for bundle in dispatched
+                        if self.journal.state(bundle["uuid"], bundle["version"]) != CheckpointJournal.LOADED}
+            bundle_list_path = f"{self.sd}/bundle_list/{prefix}.jsonl"
+            with open(f"{bundle_list_path}.tmp", "w") as fh:
+                for bundle in self._read_bundle_list("bundle_list", prefix):
+                    if not incremental:
+                        if self.journal.state(bundle["uuid"], bundle["version"]) != CheckpointJournal.LOADED:
+                            continue
+                    elif (bundle["uuid"], bundle["version"]) in unloaded:
+                        continue
+                    json.dump(bundle, fh)
+                    fh.write("\n")
+            os.replace(f"{bundle_list_path}.tmp", bundle_list_path)
+            os.remove(f"{bundle_list_path}.next")
+
+    def _make_bundle_list_dirs(self, incremental=False):
+        os.makedirs(f"{self.sd}/bundle_list", exist_ok=True)
+        if incremental:
+            os.makedirs(f"{self.sd}/bundle_list_new", exist_ok=True)
+            os.makedirs(f"{self.sd}/bundle_list_deleted", exist_ok=True)
+
+    def get_list_of_all_bundles(self, prefix, reuse_existing=False, incremental=False,
+                                bundle_handler: callable = None, deferred=False):
+        """
+        Lists all bundles whose UUIDs start with prefix into bundle_list/<prefix>.jsonl and returns the number of
+        bundles to be scanned. If deferred is True, as it is for extract(), the listing is written to
+        bundle_list/<prefix>.jsonl.next instead, and only replaces bundle_list/<prefix>.jsonl once the extraction
+        completes.
+
+        If incremental is True, the listing is compared with the one left by the previous run: bundles that were not
+        previously listed are written to bundle_list_new/<prefix>.jsonl, and bundles that are no longer listed are
+        written to bundle_list_deleted/<prefix>.jsonl. Only new bundles are counted.
+
+        If bundle_handler is given, it is called with each bundle to be scanned as soon as it is listed.
+        """
+        bundle_list_path = f"{self.sd}/bundle_list/{prefix}.jsonl"
+        next_bundle_list_path = f"{bundle_list_path}.next"
+        new_bundle_list_path = f"{self.sd}/bundle_list_new/{prefix}.jsonl"
+        deleted_bundle_list_path = f"{self.sd}/bundle_list_deleted/{prefix}.jsonl"
+        if incremental:
+            reusable = reuse_existing and os.path.exists(next_bundle_list_path) and os.path.exists(new_bundle_list_path)
+        else:
+            reusable = reuse_existing and (os.path.exists(next_bundle_list_path) or os.path.exists(bundle_list_path))
+        if reusable:
+            bundles_seen = 0
+            for bundle in self._read_bundle_list("bundle_list_new" if incremental else "bundle_list", prefix):
+                if bundle_handler is not None:
+                    bundle_handler(bundle)
+                bundles_seen += 1
+            return bundles_seen
+        previous_bundles = {}
+        if incremental and os.path.exists(bundle_list_path):
+            with open(bundle_list_path) as fh:
+                for line in fh:
+                    bundle = json.loads(line)
+                    previous_bundles[bundle["uuid"], bundle["version"]] = bundle
         bundles_seen = 0
-        with open(f"{self.sd}/bundle_list/{prefix}.jsonl", "w") as fh:
+        # Listings are written to temporary files and renamed when complete, so a listing interrupted by a crash is
+        # never reused. The full listing is renamed last. When deferred, it only becomes the previous listing for the
+        # next run once the extraction completes (see _promote_bundle_lists()).
+        with open(f"{bundle_list_path}.tmp", "w") as fh, \
+                open(f"{new_bundle_list_path}.tmp" if incremental else os.devnull, "w") as new_fh:
             for bundle in self.dss_client.get_bundles_all.iterate(replica="aws", per_page=500, prefix=prefix):
                 json.dump(bundle, fh)
                 fh.write("\n")
+                if incremental:
+                    if previous_bundles.pop((bundle["uuid"], bundle["version"]), None) is not None:
+                        continue
+                    json.dump(bundle, new_fh)
+                    new_fh.write("\n")
+                if bundle_handler is not None:
+                    bundle_handler(bundle)
                 bundles_seen += 1
+        if incremental:
+            with open(f"{deleted_bundle_list_path}.tmp", "w") as fh:
+                for bundle in previous_bundles.values():
+                    json.dump(bundle, fh)
+                    fh.write("\n")
+            os.replace(f"{new_bundle_list_path}.tmp", new_bundle_list_path)
+            os.replace(f"{deleted_bundle_list_path}.tmp", deleted_bundle_list_path)
+        if deferred:
+            os.replace(f"{bundle_list_path}.tmp", next_bundle_list_path)
+        else:
+            os.replace(f"{bundle_list_path}.tmp", bundle_list_path)
+            # A listing left by an interrupted extraction would be read instead of this one
+            if os.path.exists(next_bundle_list_path):
+                os.remove(next_bundle_list_path)
         return bundles_seen
 
+    def count_bundles(self, query=None, max_workers=512,
+                      dispatch_executor_class: concurrent.futures.Executor = concurrent.futures.ThreadPoolExecutor,
+                      resume=False, incremental=False, shard_index=0, shard_count=1, deferred=False):
+        """
+        Returns the number of bundles that will be scanned. With no query, this lists all bundles in the shard into the
+        staging directory, to be read back by page_bundles(); see get_list_of_all_bundles() for deferred. When
+        resuming, prefixes already listed are not listed again. With a query, the count is the total number of hits,
+        regardless of sharding.
+        """
+        if query is None:
+            self._make_bundle_list_dirs(incremental=incremental)
+            list_prefix = functools.partial(self.get_list_of_all_bundles,
+                                            reuse_existing=resume, incremental=incremental, deferred=deferred)
+            with dispatch_executor_class(max_workers=max_workers) as executor:
+                prefixes = (f'{i:02x}' for i in range(256) if i % shard_count == shard_index)
+                return sum(executor.map(list_prefix, prefixes))
+        elif incremental:
+            raise ValueError("Incremental extraction compares listings of all bundles and cannot be used with a query")
+        else:
+            return self.dss_client.post_search(es_query=query, replica="aws")["total_hits"]
+
     def extract(self, query=None, max_workers=512, max_dispatchers=1, page_size=500,
                 dispatch_executor_class: concurrent.futures.Executor = concurrent.futures.ThreadPoolExecutor,
                 transformer: callable = None, loader: callable = None, finalizer: callable = None,
-                page_processor: callable = None):
+                page_processor: callable = None, max_bundles_in_flight=None, resume=False, incremental=False,
+                deletion_handler: callable = None, transform_workers=None,
+                transform_executor_class: concurrent.futures.Executor = None, transform_queue_size=None,
+                load_workers=None, load_queue_size=None, batch_loader: callable = None, batch_size=500,
+                batch_flush_interval=None, shard_index=0, shard_count=1, metrics_callback: callable = None,
+                status_file=None, status_interval=10, bundles=None):
+        """
+        Extracts bundles using a sliding window of up to max_bundles_in_flight bundles (by default, twice max_workers).
+        New bundles are dispatched as soon as earlier ones complete, even across page boundaries, so that workers are
+        not left idle at the tail of each page. page_processor is still called once per page, in page order, with the
+        results of that page.
+
+        With no query, all bundles are listed by UUID prefix on a thread pool while they are being extracted: bundles
+        are dispatched as soon as they are listed, in pages of page_size bundles, and the listings are written to the
+        staging directory as before.
+
+        The progress of each bundle is recorded in a checkpoint journal in the staging directory. With resume=True,
+        bundles that were loaded by a previous, interrupted extraction are skipped; bundles that failed or did not
+        complete are extracted again. Otherwise, the journal is cleared when the extraction starts.
+
+        With incremental=True (only available without a query), the listing of all bundles is compared with the
+        listing left in the staging directory by the previous run, and only bundles that were not previously listed
+        are dispatched. deletion_handler, if given, is called with the UUID and version of each bundle that is no
+        longer listed, as the listing of its prefix completes. The listing only replaces the previous one once the
+        extraction completes, and without the bundles that failed, so that bundles are dispatched again by the next
+        incremental extraction until they have been loaded.
+
+        By default, each bundle is fetched and transformed by the same dispatch executor worker, and loaded on the
+        calling thread. Setting transform_workers or transform_executor_class (for example, to
+        concurrent.futures.ProcessPoolExecutor for CPU-bound transformers) moves transforms to a separate pool, and
+        setting load_workers runs loaders on a separate thread pool. transform_queue_size and load_queue_size bound
+        the number of bundles being processed by each stage: bundles ready for a full stage are held until it has
+        room, and while either stage is full or has bundles waiting for it, no new bundles are fetched.
+
+        batch_loader, which may be passed instead of loader, is called with lists of transformed bundles, so that
+        they can be written with bulk operations. A batch is passed on when it reaches batch_size bundles or, if
+        batch_flush_interval is set, when its first bundle has waited that many seconds. Any remaining bundles are
+        passed on before the finalizer is called. Pages are only passed to page_processor once all of their bundles
+        have been loaded.
+
+        A scan can be split across processes or hosts by running extract() once per shard with shard_count and a
+        distinct shard_index in range(shard_count); see extract_sharded(). Returns a dictionary of statistics about the
+        extraction.
+
+        If the extractor was created with a cache budget (cache_max_bytes or cache_max_bundles), bundles are evicted
+        from the staging area as needed while the extraction runs; see dcplib.etl.cache. Bundles being processed are
+        never evicted.
+
+        Counters and per-stage latencies are collected in self.metrics (see dcplib.etl.metrics). Every status_interval
+        seconds, and once the extraction completes, a snapshot of the metrics is passed to metrics_callback and
+        written to status_file as JSON, if they are given.
+
+        If the extractor was created with a concurrency_limiter (see dcplib.etl.concurrency), the number of bundles
+        being fetched is further limited to its current limit, which grows and shrinks with the latency and throttling
+        responses of the extractor's HTTP requests, and no bundles are dispatched while DSS has asked for requests to
+        be retried later.
+
+        Bundles that fail are recorded, with the stage and file that failed and the error, in self.errors (see
+        dcplib.etl.stores.ErrorStore), and their records are removed once they are loaded. Instead of a query,
+        bundles may be given a list of dictionaries with the "uuid" and "version" of each bundle to extract; see
+        retry_failed().
+        """
+        if loader is not None and batch_loader is not None:
+            raise ValueError("Pass either a loader or a batch_loader, not both")
         start = time.time()
-        if query is None:
-            os.makedirs(f"{self.sd}/bundle_list", exist_ok=True)
-            with dispatch_executor_class(max_workers=max_workers) as executor:
-                total_bundles = sum(executor.map(self.get_list_of_all_bundles, (f'{i:02x}' for i in range(256))))
+        self.metrics.reset()
+        if loader is not None:
+            loader = self.metrics.timed("load", loader)
+        if batch_loader is not None:
+            batch_loader = self.metrics.timed("load", batch_loader)
+        reporting = metrics_callback is not None or status_file is not None
+        next_report = start + status_interval
+
+        def report():
+            if metrics_callback is not None:
+                metrics_callback(self.metrics.snapshot())
+            if status_file is not None:
+                self.metrics.write_status(status_file)
+        if not resume:
+            self.journal.clear(shard_index=shard_index, shard_count=shard_count)
+        # With no query or bundles, all bundles in the shard are listed
+        listing_all = query is None and bundles is None
+        if bundles is not None:
+            bundles = [bundle for bundle in bundles if in_shard(bundle["uuid"], shard_index, shard_count)]
+            total_bundles = len(bundles)
+            logger.info("Scanning %s bundles", total_bundles)
+        elif query is None:
+            # Bundles are listed while they are extracted; total_bundles grows as each prefix listing completes.
+            self._make_bundle_list_dirs(incremental=incremental)
+            total_bundles = 0
+            logger.info("Listing and scanning bundles")
         else:
-            total_bundles = self.dss_client.post_search(es_query=query, replica="aws")["total_hits"]
+            total_bundles = self.count_bundles(query=query, incremental=incremental)
             if total_bundles == 0:
                 logger.error("No bundles found, nothing to do")
-                return
-        logger.info("Scanning %s bundles", total_bundles)
+                return dict(total_bundles=0, extracted_bundles=0, failed_bundles=0, elapsed_seconds=time.time() - start)
+            logger.info("Scanning %s bundles", total_bundles)
+        max_bundles_in_flight = max_bundles_in_flight or 2 * max_workers
         extracted_bundle_count, error_bundle_count = 0, 0
-        with dispatch_executor_class(max_workers=max_workers) as executor:
-            for page in self.page_bundles(query=query, replica="aws", page_size=page_size):
-                logger.info(f"Extracted bundles: {extracted_bundle_count} "
-                            f"({extracted_bundle_count/total_bundles:.1%}, {error_bundle_count} errors)")
-                futures = []
-                extracted_results = []
-                bundles = page['results'] if 'results' in page else page
-                for bundle in bundles:
-                    if "bundle_fqid" in bundle:
-                        bundle["uuid"], bundle["version"] = bundle["bundle_fqid"].split(".", 1)
-                    f = executor.submit(self.extract_transform_one, bundle["uuid"], bundle["version"], transformer)
-                    futures.append(f)
-
-                for future in concurrent.futures.as_completed(futures):
+        pages = collections.deque()
+        # Maps each pending future to the stage it belongs to, and to the page and bundle it is processing
+        in_flight = {}
+        stage_counts = collections.Counter()
+        with contextlib.ExitStack() as executors:
+            executor = executors.enter_context(dispatch_executor_class(max_workers=max_workers))
+            transform_executor, load_executor = None, None
+            if transform_workers is not None or transform_executor_class is not None:
+                transform_executor_class = transform_executor_class or concurrent.futures.ThreadPoolExecutor
+                # Unlike threads, which mostly wait on I/O, each transform process uses a core.
+                default_transform_workers = max_workers
+                if issubclass(transform_executor_class, concurrent.futures.ProcessPoolExecutor):
+                    default_transform_workers = os.cpu_count()
+                transform_executor = executors.enter_context(
+                    transform_executor_class(max_workers=transform_workers or default_transform_workers)
+                )
+            if load_workers is not None and (loader is not None or batch_loader is not None):
+                load_executor = executors.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=load_workers))
+
+            executors.callback(self._shutdown_fetch_executor)
+            stage_executors = dict(extract=executor, extract_transform=executor, transform=transform_executor,
+                                   load=load_executor)
+
+            # Maps each pending prefix listing future to its prefix. Listings run on threads, which pass the bundles
+            # they list to the scheduler through listed_bundles. The queue holds a few pages of bundles, so that
+            # listings wait for the extraction rather than holding every listed bundle in memory.
+            listing = {}
+            listed_bundles = queue.Queue(maxsize=2 * page_size)
+            stop_listing = threading.Event()
+
+            def list_bundle(bundle):
+                # Listings still waiting for room in the queue are stopped when the extraction ends, for instance on
+                # an error, so that it does not wait for every listing to complete.
+                while not stop_listing.is_set():
                     try:
-                        extracted_results.append(future.result())
+                        listed_bundles.put(bundle, timeout=self.listing_poll_interval)
+                        return
+                    except queue.Full:
+                        pass
+                raise _ListingStopped()
+
+            def stop_listings():
+                stop_listing.set()
+                for f in listing:
+                    f.cancel()
+
+            if listing_all:
+                prefixes = [f'{i:02x}' for i in range(256) if i % shard_count == shard_index]
+                listing_executor = executors.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(prefixes)))
+                )
+                executors.callback(stop_listings)
+                for prefix in prefixes:
+                    f = listing_executor.submit(self.get_list_of_all_bundles, prefix, reuse_existing=resume,
+                                                incremental=incremental, bundle_handler=list_bundle, deferred=True)
+                    listing[f] = prefix
+
+            def submit(stage, page, bundle, fn, *args, **kwargs):
+                f = stage_executors[stage].submit(fn, *args, **kwargs)
+                in_flight[f] = stage, page, bundle
+                stage_counts[stage] += 1
+
+            # Bundles ready for the transform or load stage while it is full, as (page, bundle, fn) tuples
+            held = dict(transform=collections.deque(), load=collections.deque())
+            stage_queue_sizes = dict(transform=transform_queue_size, load=load_queue_size)
+
+            def stage_full(stage):
+                return stage_queue_sizes[stage] is not None and stage_counts[stage] >= stage_queue_sizes[stage]
+
+            def submit_or_hold(stage, page, bundle, fn):
+                if held[stage] or stage_full(stage):
+                    held[stage].append((page, bundle, fn))
+                else:
+                    submit(stage, page, bundle, fn)
+
+            def release_held():
+                for stage, bundles_held in held.items():
+                    while bundles_held and not stage_full(stage):
+                        submit(stage, *bundles_held.popleft())
+
+            # Bundles being processed, which are never evicted from the staging area
+            pinned = set()
+
+            def finish(page, bundle):
+                page.pending -= 1
+                pinned.discard((bundle["uuid"], bundle["version"]))
+                self.journal.record(bundle["uuid"], bundle["version"], CheckpointJournal.LOADED)
+                self.errors.resolve(bundle["uuid"], bundle["version"])
+
+            # Transformed bundles waiting to be passed to batch_loader, as (page, bundle, result) tuples
+            batch, batch_started = [], None
+
+            def flush_batch():
+                nonlocal batch, batch_started
+                entries, batch, batch_started = batch, [], None
+                results = [result for page, bundle, result in entries]
+                if load_executor is not None:
+                    submit_or_hold("load", None, entries, functools.partial(batch_loader, bundles=results))
+                else:
+                    batch_loader(bundles=results)
+                    for page, bundle, result in entries:
+                        finish(page, bundle)
+
+            if listing_all:
+                bundles = self._iter_listed_page_bundles(pages, listed_bundles, listing, page_size=page_size,
+                                                         resume=resume)
+            else:
+                bundles = self._iter_page_bundles(pages, query=query, page_size=page_size, resume=resume,
+                                                  shard_index=shard_index, shard_count=shard_count, bundles=bundles)
+            # The next bundle to dispatch, taken from bundles before there is room for it. The generator is advanced
+            # even while no bundles can be dispatched, so that the last page is marked as dispatched, and the end of
+            # the bundles is noticed, as soon as every bundle has been dispatched.
+            next_item, exhausted = None, False
+            while True:
+                release_held()
+                held_count = len(held["transform"]) + len(held["load"])
+                # Stop fetching new bundles while a downstream stage is backed up
+                backed_up = held_count or stage_full("transform") or stage_full("load")
+                room = 0 if backed_up else max_bundles_in_flight - len(in_flight)
+                retry_delay = self.concurrency_limiter.retry_delay() if self.concurrency_limiter else 0
+                if room > 0 and self.concurrency_limiter is not None:
+                    fetching = stage_counts["extract"] + stage_counts["extract_transform"]
+                    room = 0 if retry_delay else min(room, self.concurrency_limiter.limit - fetching)
+                waiting_for_listing = False
+                while not exhausted:
+                    if next_item is None:
+                        next_item = next(bundles, StopIteration)
+                        if next_item is StopIteration:
+                            next_item, exhausted = None, True
+                            break
+                        if next_item is None:
+                            waiting_for_listing = True
+                            break
+                    if room <= 0:
+                        break
+                    (page, bundle), next_item = next_item, None
+                    room -= 1
+                    if transform_executor is not None:
+                        submit("extract", page, bundle, self.extract_one, bundle["uuid"], bundle["version"])
+                    else:
+                        submit("extract_transform", page, bundle, self.extract_transform_one, bundle["uuid"],
+                               bundle["version"], transformer)
+                    page.pending += 1
+                    pinned.add((bundle["uuid"], bundle["version"]))
+                if batch and not in_flight:
+                    flush_batch()
+                while pages and pages[0].done:
+                    page = pages.popleft()
+                    logger.info(f"Extracted bundles: {extracted_bundle_count} "
+                                f"({extracted_bundle_count/max(total_bundles, 1):.1%}, {error_bundle_count} errors)")
+                    if page_processor is not None:
+                        page_processor(page.results)
+                # A Retry-After only delays bundles that are still to be dispatched
+                if not in_flight and not held_count and exhausted:
+                    break
+                if reporting and time.time() >= next_report:
+                    report()
+                    next_report = time.time() + status_interval
+                deadlines = [next_report] if reporting else []
+                if batch and batch_flush_interval is not None:
+                    deadlines.append(batch_started + batch_flush_interval)
+                if waiting_for_listing:
+                    deadlines.append(time.time() + self.listing_poll_interval)
+                if retry_delay and not exhausted:
+                    deadlines.append(time.time() + retry_delay)
+                timeout = max(min(deadlines) - time.time(), 0) if deadlines else None
+                done, _ = concurrent.futures.wait(list(in_flight) + list(listing), timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in listing:
+                        prefix = listing.pop(future)
+                        total_bundles += future.result()
+                        if incremental and deletion_handler is not None:
+                            for bundle in self._read_bundle_list("bundle_list_deleted", prefix):
+                                deletion_handler(bundle_uuid=bundle["uuid"], bundle_version=bundle["version"],
+                                                 extractor=self)
+                        continue
+                    stage, page, bundle = in_flight.pop(future)
+                    stage_counts[stage] -= 1
+                    if stage == "load" and page is None:
+                        future.result()
+                        for page, bundle, result in bundle:
+                            finish(page, bundle)
+                        continue
+                    elif stage == "load":
+                        future.result()
+                    else:
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            error_bundle_count += 1
+                            self.metrics.increment("bundles_failed")
+                            self.errors.record(bundle["uuid"], bundle["version"], stage, e)
+                            page.pending -= 1
+                            pinned.discard((bundle["uuid"], bundle["version"]))
+                            self.journal.record(bundle["uuid"], bundle["version"], CheckpointJournal.FAILED)
+                            if self._continue_on_bundle_extract_errors:
+                                continue
+                            else:
+                                raise
+                        if stage == "extract":
+                            submit_or_hold("transform", page, bundle,
+                                           functools.partial(self.transform_one, bundle["uuid"], bundle["version"],
+                                                             transformer))
+                            continue
+                        page.results.append(result)
                         extracted_bundle_count += 1
-                    except Exception:
-                        error_bundle_count += 1
-                        if self._continue_on_bundle_extract_errors:
+                        self.metrics.increment("bundles_extracted")
+                        if batch_loader is not None and result is not None:
+                            batch_started = batch_started or time.time()
+                            batch.append((page, bundle, result))
+                            if len(batch) >= batch_size:
+                                flush_batch()
                             continue
-                        else:
-                            raise
-                    if loader is not None and extracted_results[-1] is not None:
-                        loader(bundle=extracted_results[-1])
-                if page_processor is not None:
-                    page_processor(extracted_results)
+                        if loader is not None and result is not None:
+                            if load_executor is not None:
+                                submit_or_hold("load", page, bundle, functools.partial(loader, bundle=result))
+                                continue
+                            loader(bundle=result)
+                    finish(page, bundle)
+                if batch and batch_flush_interval is not None and time.time() >= batch_started + batch_flush_interval:
+                    flush_batch()
+                if self.cache is not None:
+                    self.cache.evict(pinned=pinned, shard_index=shard_index, shard_count=shard_count)
 
+        if listing_all:
+            self._promote_bundle_lists(incremental=incremental, shard_index=shard_index, shard_count=shard_count)
+        if reporting:
+            report()
         if finalizer is not None:
             finalizer(extractor=self)
         end = time.time()
         logger.info(f"Processed {total_bundles} bundles in {round(end - start)} seconds")
         logger.info(f"Successfully extracted {extracted_bundle_count} bundles")
-        logger.info(f"Failures in {error_bundle_count} bundles (see {self.sd}/errors)")
+        logger.info(f"Failures in {error_bundle_count} bundles (see {self.staging.db_path})")
+        return dict(total_bundles=total_bundles, extracted_bundles=extracted_bundle_count,
+                    failed_bundles=error_bundle_count, elapsed_seconds=end - start)
+
+    def retry_failed(self, **extract_kwargs):
+        """
+        Extracts again the bundles recorded as failed in self.errors, counting a retry for each, and returns the
+        statistics of the extraction. Bundles already loaded since are skipped. Keyword arguments are passed to
+        extract().
+        """
+        failed = [dict(uuid=bundle_uuid, version=bundle_version) for bundle_uuid, bundle_version in
+                  self.errors.failed_bundles()]
+        for bundle in failed:
+            self.errors.count_retry(bundle["uuid"], bundle["version"])
+        return self.extract(bundles=failed, resume=True, **extract_kwargs)
+
+    def _iter_page_bundles(self, pages, query=None, page_size=None, resume=False, incremental=False, shard_index=0,
+                           shard_count=1, bundles=None):
+        """
+        Yields (page, bundle) pairs, appending the state of each page to pages as it is started. A page is marked as
+        fully dispatched when the next page is started. Bundles outside the shard are skipped, as are bundles already
+        loaded when resuming.
+        """
+        for bundles in self.page_bundles(query=query, replica="aws", page_size=page_size, incremental=incremental,
+                                         shard_index=shard_index, shard_count=shard_count, bundles=bundles):
+            page = _PageState()
+            pages.append(page)
+            for bundle in bundles['results'] if 'results' in bundles else bundles:
+                if "bundle_fqid" in bundle:
+                    bundle["uuid"], bundle["version"] = bundle["bundle_fqid"].split(".", 1)
+                if not in_shard(bundle["uuid"], shard_index, shard_count):
+                    continue
+                if resume and self.journal.state(bundle["uuid"], bundle["version"]) == CheckpointJournal.LOADED:
+                    continue
+                yield page, bundle
+            page.dispatched = True
+
+    def _iter_listed_page_bundles(self, pages, listed_bundles, listing, page_size=None, resume=False):
+        """
+        Like _iter_page_bundles(), but pages bundles as they are passed to listed_bundles by the prefix listings in
+        listing, yielding None whenever no listed bundle is available yet. Pages are filled in the order bundles are
+        listed. The last page is marked as dispatched once all listings are complete and their bundles have been
+        yielded.
+        """
+        page, page_bundle_count = None, 0
+        while True:
+            listing_done = not listing
+            try:
+                bundle = listed_bundles.get_nowait()
+            except queue.Empty:
+                if listing_done:
+                    break
+                yield None
+                continue
+            if page is None:
+                page, page_bundle_count = _PageState(), 0
+                pages.append(page)
+            page_bundle_count += 1
+            if not resume or self.journal.state(bundle["uuid"], bundle["version"]) != CheckpointJournal.LOADED:
+                yield page, bundle
+            if page_bundle_count == page_size:
+                page.dispatched, page = True, None
+        if page is not None:
+            page.dispatched = True
 
     def get_files_to_fetch_for_bundle(self, bundle_uuid, bundle_version):
-        # get the bundle manifest and store in file system
-        try:
-            with open(f"{self.sd}/bundle_manifests/{bundle_uuid}.{bundle_version}.json") as fh:
-                bundle_manifest = json.load(fh)
+        logger.debug("Scanning bundle %s", bundle_uuid)
+        if self._bundle_checkout:
+            return self.checkout_files_for_bundle(bundle_uuid, bundle_version)
+        fetch_one = functools.partial(self._fetch_file_if_not_cached, bundle_uuid=bundle_uuid,
+                                      bundle_version=bundle_version)
+        fetched_files, fetch_file_errors, fetches = [], [], []
+
+        def collect(f, fetch):
+            try:
+                if fetch():
+                    fetched_files.append(f)
+            except Exception as e:
+                self._record_error("file", bundle_uuid, bundle_version, e, f=f)
+                fetch_file_errors.append(e)
+
+        # Files are passed on to be fetched as each page of the manifest arrives, rather than once it is complete.
+        for manifest_files in self._iter_bundle_manifest_pages(bundle_uuid, bundle_version):
+            for f in manifest_files:
+                if not self._should_fetch_file(f):
+                    logger.debug("Skipping file %s/%s (no filter match)", bundle_uuid, f["name"])
+                elif self.fetch_executor is None:
+                    collect(f, functools.partial(fetch_one, f))
+                else:
+                    fetches.append((f, self.fetch_executor.submit(fetch_one, f)))
+        for f, future in fetches:
+            collect(f, future.result)
+        for e in fetch_file_errors:
+            raise e
+        return bundle_uuid, bundle_version, fetched_files
+
+    def _iter_bundle_manifest_pages(self, bundle_uuid, bundle_version):
+        """
+        Yields the files listed on each page of the bundle manifest as soon as the page is fetched, and stores the
+        complete manifest in the staging area after the last page. DSS links each page to the next with an opaque
+        token, so pages can only be requested one at a time.
+        """
+        bundle_manifest = self.staging.load_manifest(bundle_uuid, bundle_version)
+        if bundle_manifest is not None:
             logger.debug("[%s] Loaded cached manifest for bundle %s", threading.current_thread().getName(), bundle_uuid)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            logger.debug("[%s] Fetching manifest for bundle %s", threading.current_thread().getName(), bundle_uuid)
+            self.metrics.increment("manifest_cache_hits")
+            yield bundle_manifest["files"]
+            return
+        logger.debug("[%s] Fetching manifest for bundle %s", threading.current_thread().getName(), bundle_uuid)
+        self.metrics.increment("manifests_fetched")
+        with self.metrics.timer("manifest_fetch"):
             res = self._http.get(f"{self.dss_client.host}/bundles/{bundle_uuid}", params={"replica": "aws"})
             try:
                 res.raise_for_status()
             except Exception as e:
-                with open(f"{self.sd}/errors/{threading.current_thread().getName()}.log", "a") as fh:
-                    traceback.print_tb(e.__traceback__, file=fh)
-                    print(f"{bundle_uuid}.{bundle_version} {type(e)} {str(e)}", file=fh)
+                self._record_error("manifest", bundle_uuid, bundle_version, e)
                 raise
             bundle_manifest = res.json()["bundle"]
-            while res.links.get("next", {}).get("url"):
+        yield list(bundle_manifest["files"])
+        while res.links.get("next", {}).get("url"):
+            with self.metrics.timer("manifest_fetch"):
                 res = self._http.get(res.links["next"]["url"], params={"replica": "aws"})
                 res.raise_for_status()
-                bundle_manifest["files"].extend(res.json()["bundle"]["files"])
-            os.makedirs(f"{self.sd}/bundle_manifests", exist_ok=True)
-            with open(f"{self.sd}/bundle_manifests/{bundle_uuid}.{bundle_version}.json", "w") as fh:
-                json.dump(bundle_manifest, fh)
+                manifest_files = res.json()["bundle"]["files"]
+            bundle_manifest["files"].extend(manifest_files)
+            yield manifest_files
+        self.staging.save_manifest(bundle_uuid, bundle_version, bundle_manifest)
 
-        logger.debug("Scanning bundle %s", bundle_uuid)
-        fetched_files, fetch_file_errors = [], []
-        # For each file in the bundle, check if it has been fetched, validate the checksum, and link it in the bundle
-        # directory. Otherwise, call get_file() to fetch it.
-        for f in bundle_manifest["files"]:
-            if self._should_fetch_file(f):
-                os.makedirs(f"{self.sd}/bundles/{bundle_uuid}.{bundle_version}", exist_ok=True)
-                os.makedirs(f"{self.sd}/files/{bundle_uuid}.{bundle_version}", exist_ok=True)
-                try:
-                    with open(f"{self.sd}/files/{f['uuid']}.{f['version']}", "rb") as fh:
-                        file_csum = hashlib.sha256(fh.read()).hexdigest()
-                        if file_csum == f["sha256"]:
-                            self._link_file(bundle_uuid, bundle_version, f)
-                            continue
-                except (FileNotFoundError,):
-                    try:
-                        self.get_file(f, bundle_uuid, bundle_version)
-                        fetched_files.append(f)
-                    except Exception as e:
-                        logger.debug(f"Error while fetching file {f['uuid']}.{f['version']}: %s", e)
-                        fetch_file_errors.append(e)
-            else:
-                logger.debug("Skipping file %s/%s (no filter match)", bundle_uuid, f["name"])
-            for e in fetch_file_errors:
-                raise e
-        return bundle_uuid, bundle_version, fetched_files
+    def checkout_files_for_bundle(self, bundle_uuid, bundle_version):
+        """
+        Checks out the bundle if any of its files are not staged yet, then fetches them from the checkout location.
+        The byte ranges of all files are fetched in parallel on the shared fetch pool, if there is one.
+        """
+        files = []
+        for manifest_files in self._iter_bundle_manifest_pages(bundle_uuid, bundle_version):
+            for f in manifest_files:
+                if not self._should_fetch_file(f):
+                    logger.debug("Skipping file %s/%s (no filter match)", bundle_uuid, f["name"])
+                elif self._is_cached(f, bundle_uuid, bundle_version):
+                    self.staging.link_file(bundle_uuid, bundle_version, f)
+                else:
+                    files.append(f)
+        if not files:
+            return bundle_uuid, bundle_version, files
+        try:
+            with self.metrics.timer("checkout"):
+                location = self.checkout_bundle(bundle_uuid, bundle_version)
+        except Exception as e:
+            self._record_error("checkout", bundle_uuid, bundle_version, e)
+            raise
+        tmp_file_paths, range_fetches = {}, []
+        try:
+            for f in files:
+                tmp_file_path = tmp_file_paths[f["uuid"], f["version"]] = self.staging.tmp_file_path(f)
+                with open(tmp_file_path, "wb") as fh:
+                    if f.get("size"):
+                        fh.truncate(f["size"])
+                url = self.checkout_file_url(location, f)
+                if not f.get("size") or f["size"] <= self._checkout_range_size:
+                    ranges = [None]
+                else:
+                    ranges = [(start, min(start + self._checkout_range_size, f["size"]) - 1)
+                              for start in range(0, f["size"], self._checkout_range_size)]
+                for byte_range in ranges:
+                    if self.fetch_executor is None:
+                        self._get_checkout_range(url, tmp_file_path, byte_range)
+                    else:
+                        range_fetches.append(self.fetch_executor.submit(self._get_checkout_range, url, tmp_file_path,
+                                                                        byte_range))
+            for future in range_fetches:
+                future.result()
+            for f in files:
+                self._verify_file(tmp_file_paths[f["uuid"], f["version"]], f, bundle_uuid, bundle_version)
+        except Exception as e:
+            for future in range_fetches:
+                future.cancel()
+            concurrent.futures.wait(range_fetches)
+            for tmp_file_path in tmp_file_paths.values():
+                if os.path.exists(tmp_file_path):
+                    os.unlink(tmp_file_path)
+            self._record_error("checkout", bundle_uuid, bundle_version, e)
+            raise
+        for f in files:
+            self.staging.commit_file(tmp_file_paths[f["uuid"], f["version"]], f)
+            self.staging.link_file(bundle_uuid, bundle_version, f)
+            self._update_cached_size(f)
+        self.metrics.increment("files_fetched", len(files))
+        return bundle_uuid, bundle_version, files
+
+    def checkout_bundle(self, bundle_uuid, bundle_version):
+        """
+        Starts a checkout of the bundle and waits for it to complete. Returns the checkout location.
+        """
+        res = self._http.post(f"{self.dss_client.host}/bundles/{bundle_uuid}/checkout",
+                              params={"replica": "aws", "version": bundle_version}, json={})
+        res.raise_for_status()
+        checkout_job_id = res.json()["checkout_job_id"]
+        deadline = time.time() + self.checkout_timeout
+        while True:
+            res = self._http.get(f"{self.dss_client.host}/bundles/checkout/{checkout_job_id}",
+                                 params={"replica": "aws"})
+            res.raise_for_status()
+            checkout_status = res.json()
+            if checkout_status["status"] == "SUCCEEDED":
+                return checkout_status["location"]
+            elif checkout_status["status"] == "FAILED":
+                raise DSSCheckoutError(f"Checkout of {bundle_uuid}.{bundle_version} failed: {checkout_status}")
+            elif time.time() > deadline:
+                raise DSSCheckoutError(f"Checkout of {bundle_uuid}.{bundle_version} did not complete in "
+                                       f"{self.checkout_timeout} seconds")
+            time.sleep(self.checkout_poll_interval)
+
+    @staticmethod
+    def checkout_file_url(location, f):
+        """
+        Returns the URL of a file in a checkout location. S3 locations are mapped to their HTTPS endpoints.
+        """
+        if location.startswith("s3://"):
+            bucket, _, key = location[len("s3://"):].partition("/")
+            location = f"https://{bucket}.s3.amazonaws.com/{key}"
+        return f"{location.rstrip('/')}/{urllib.parse.quote(f['name'])}"
+
+    def _get_checkout_range(self, url, tmp_file_path, byte_range=None):
+        """
+        Writes the given (first, last) byte range of the file at url, or all of it, at the same offset in
+        tmp_file_path.
+        """
+        headers = {"Range": "bytes={}-{}".format(*byte_range)} if byte_range else {}
+        with self.metrics.timer("file_fetch"):
+            res = self._http.get(url, headers=headers, stream=True)
+            try:
+                res.raise_for_status()
+                if byte_range and res.status_code != 206:
+                    raise DSSCheckoutError(f"Expected a partial response for {url} ({headers['Range']}), "
+                                           f"got status {res.status_code}")
+                with open(tmp_file_path, "r+b") as fh:
+                    fh.seek(byte_range[0] if byte_range else 0)
+                    for chunk in res.iter_content(chunk_size=self._download_chunk_size):
+                        fh.write(chunk)
+                        self.metrics.increment("bytes_fetched", len(chunk))
+                    if not byte_range:
+                        fh.truncate()
+            finally:
+                res.close()
+
+    def _verify_file(self, file_path, f, bundle_uuid, bundle_version):
+        with self.metrics.timer("checksum"):
+            sink = ChecksummingSink(self._download_chunk_size, hash_functions=("sha256",))
+            with open(file_path, "rb") as fh:
+                for chunk in iter(lambda: fh.read(self._download_chunk_size), b""):
+                    sink.write(chunk)
+            file_csum = sink.get_checksums()["sha256"]
+        if file_csum != f["sha256"]:
+            raise ChecksumMismatch(f"{bundle_uuid}.{bundle_version}/{f['uuid']}.{f['version']} {f['name']}: "
+                                   f"expected sha256 {f['sha256']}, got {file_csum}")
+
+    def _fetch_file_if_not_cached(self, f, bundle_uuid, bundle_version):
+        """
+        If the file has already been staged and its checksum is valid, links it in the bundle directory. Otherwise,
+        calls get_file() to fetch it. Returns True if the file was fetched.
+        """
+        if self._is_cached(f, bundle_uuid, bundle_version):
+            self.staging.link_file(bundle_uuid, bundle_version, f)
+            return False
+        self.get_file(f, bundle_uuid, bundle_version)
+        self._update_cached_size(f)
+        return True
+
+    def _is_cached(self, f, bundle_uuid, bundle_version):
+        if self.cache is not None:
+            # Recorded first, so that the file cannot be evicted once it has been found
+            self.cache.add_file(bundle_uuid, bundle_version, self.staging.file_path(f), f.get("size"))
+        with self.metrics.timer("cache_check"):
+            cached = self.staging.is_cached(f)
+        self.metrics.increment("file_cache_hits" if cached else "file_cache_misses")
+        if cached:
+            self._update_cached_size(f)
+        return cached
+
+    def _update_cached_size(self, f):
+        if self.cache is not None and not f.get("size"):
+            self.cache.update_size(self.staging.file_path(f))
+
+    def _record_error(self, stage, bundle_uuid, bundle_version, e, f=None):
+        logger.debug("Error in %s stage of %s.%s%s: %s", stage, bundle_uuid, bundle_version,
+                     f" file {f['uuid']}.{f['version']} {f['name']}" if f else "", e)
+        self.errors.record(bundle_uuid, bundle_version, stage, e, f=f)
 
     def _should_fetch_file(self, f):
-        if any(fnmatchcase(f["content-type"], p) for p in self.content_type_patterns):
+        if self._content_type_regex.match(f["content-type"]):
             return True
-        if any(fnmatchcase(f["name"], p) for p in self.filename_patterns):
+        if self._filename_regex.match(f["name"]):
             return True
         return False
 
-    def _link_file(self, bundle_uuid, bundle_version, f):
-        if not os.path.exists(f"{self.sd}/bundles/{bundle_uuid}.{bundle_version}/{f['name']}"):
-            logger.debug("Linking fetched file %s/%s", bundle_uuid, f["name"])
-            os.symlink(f"../../files/{f['uuid']}.{f['version']}",
-                       f"{self.sd}/bundles/{bundle_uuid}.{bundle_version}/{f['name']}")
-
     def get_file(self, f, bundle_uuid, bundle_version, print_progress=True):
         logger.debug("[%s] Fetching %s:%s", threading.current_thread().getName(), bundle_uuid, f["name"])
+        fetch_start, checksum_seconds, file_size = time.perf_counter(), 0, 0
         res = self._http.get(f"{self.dss_client.host}/files/{f['uuid']}",
-                             params={"replica": "aws", "version": f["version"]})
+                             params={"replica": "aws", "version": f["version"]}, stream=True)
+        # Stream the response body to a temporary file, verifying its checksum on the way, then atomically rename it
+        # into place so that a partial or corrupt download is never mistaken for a cached file.
+        tmp_file_path = self.staging.tmp_file_path(f)
+        sink = ChecksummingSink(self._download_chunk_size, hash_functions=("sha256",))
         try:
             res.raise_for_status()
-        except Exception as e:
-            with open(f"{self.sd}/errors/{threading.current_thread().getName()}.log", "a") as fh:
-                traceback.print_tb(e.__traceback__, file=fh)
-                print(f"{bundle_uuid}.{bundle_version}/{f['uuid']}.{f['version']} {f['name']}", file=fh)
+            with open(tmp_file_path, "wb") as fh:
+                for chunk in res.iter_content(chunk_size=self._download_chunk_size):
+                    checksum_start = time.perf_counter()
+                    sink.write(chunk)
+                    checksum_seconds += time.perf_counter() - checksum_start
+                    fh.write(chunk)
+                    file_size += len(chunk)
+            file_csum = sink.get_checksums()["sha256"]
+            if file_csum != f["sha256"]:
+                raise ChecksumMismatch(f"{bundle_uuid}.{bundle_version}/{f['uuid']}.{f['version']} {f['name']}: "
+                                       f"expected sha256 {f['sha256']}, got {file_csum}")
+        except Exception:
+            if os.path.exists(tmp_file_path):
+                os.unlink(tmp_file_path)
             raise
-        with open(f"{self.sd}/files/{f['uuid']}.{f['version']}", "wb") as fh:
-            fh.write(res.content)
-        self._link_file(bundle_uuid, bundle_version, f)
+        finally:
+            res.close()
+        self.staging.commit_file(tmp_file_path, f)
+        self.staging.link_file(bundle_uuid, bundle_version, f)
+        self.metrics.observe("file_fetch", time.perf_counter() - fetch_start)
+        self.metrics.observe("checksum", checksum_seconds)
+        self.metrics.increment("files_fetched")
+        self.metrics.increment("bytes_fetched", file_size)
         logger.debug("Wrote %s:%s", bundle_uuid, f["name"])
         if print_progress:
             sys.stdout.write(".")
             sys.stdout.flush()
         return f, bundle_uuid, bundle_version
+
+
+def extract_sharded(extractor: DSSExtractor, shard_count, max_processes=None, finalizer: callable = None,
+                    **extract_kwargs):
+    """
+    Runs extractor.extract() for each of shard_count shards in a separate process, calls the finalizer once all
+    shards are done, and returns the statistics of all shards added together. The extractor and callbacks are sent to
+    the worker processes, so they must be picklable.
+    """
+    start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_processes or shard_count) as executor:
+        futures = [executor.submit(extractor.extract, shard_index=shard_index, shard_count=shard_count,
+                                   **extract_kwargs)
+                   for shard_index in range(shard_count)]
+        shard_stats = [future.result() for future in futures]
+    stats = collections.Counter()
+    for s in shard_stats:
+        stats.update(s)
+    if extract_kwargs.get("query") is not None:
+        # Every shard counts all search hits, not just its own
+        stats["total_bundles"] = extractor.count_bundles(query=extract_kwargs["query"])
+    stats["elapsed_seconds"] = time.time() - start
+    if finalizer is not None:
+        finalizer(extractor=extractor)
+    logger.info(f"Extracted {stats['extracted_bundles']} bundles in {shard_count} shards "
+                f"({stats['failed_bundles']} failures)")
+    return dict(stats)
@@ -0,0 +1,331 @@
+"""
+An asyncio extraction engine for DSSExtractor.
+
+AsyncDSSExtractor.extract() takes the same transformer, loader, finalizer and page_processor callbacks as
+DSSExtractor.extract(), but fetches manifests and files as asyncio tasks sharing one bounded aiohttp connection pool,
+instead of dedicating a thread and a requests session to each bundle. This lets a single process keep thousands of
+requests in flight. As in DSSExtractor.extract(), up to max_bundles_in_flight bundles are processed at once, across
+page boundaries, and page_processor is called once per page, in page order. Transformers run on a thread pool, and
+loaders, page processors and staging area, database and checksum work on the event loop's default executor, so that
+they don't block the event loop.
+
+This module requires aiohttp, which is installed with the "async" extra (pip install dcplib[async]):
+    from dcplib.etl.async_extractor import AsyncDSSExtractor
+    AsyncDSSExtractor(staging_directory=".").extract(transformer=tf, loader=ld, finalizer=fn)
+"""
+
+import os, asyncio, collections, concurrent.futures, functools, logging, time
+
+import aiohttp
+from yarl import URL
+
+from . import DSSExtractor, ChecksumMismatch, _PageState
+from .stores import CheckpointJournal
+from ..checksumming_io import ChecksummingSink
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDSSExtractor(DSSExtractor):
+    # Retry, redirect and timeout policies mirror those of dcplib.networking.HTTPRequest.
+    retry_status_codes = frozenset({429, 500, 502, 503, 504})
+    max_retries = 4
+    backoff_factor = 0.1
+    max_redirects = 1024
+    timeout_policy = aiohttp.ClientTimeout(sock_connect=20, sock_read=40)
+
+    def extract(self, query=None, max_connections=512, max_bundles_in_flight=4096, max_transform_workers=8,
+                page_size=500, transformer: callable = None, loader: callable = None, finalizer: callable = None,
+                page_processor: callable = None, resume=False, bundles=None):
+        """
+        Returns a dictionary of statistics about the extraction. As with DSSExtractor.extract(), the progress and
+        errors of each bundle are recorded in self.journal and self.errors, resume=True skips bundles that were loaded
+        by a previous extraction, and bundles may be given instead of a query; see retry_failed().
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            stats = loop.run_until_complete(self._extract(query=query,
+                                                          max_connections=max_connections,
+                                                          max_bundles_in_flight=max_bundles_in_flight,
+                                                          max_transform_workers=max_transform_workers,
+                                                          page_size=page_size,
+                                                          transformer=transformer,
+                                                          loader=loader,
+                                                          page_processor=page_processor,
+                                                          resume=resume,
+                                                          bundles=bundles))
+        finally:
+            loop.close()
+        if finalizer is not None:
+            finalizer(extractor=self)
+        return stats
+
+    async def _extract(self, query, max_connections, max_bundles_in_flight, max_transform_workers, page_size,
+                       transformer, loader, page_processor, resume, bundles):
+        start = time.time()
+        self.metrics.reset()
+        loop = asyncio.get_event_loop()
+        if not resume:
+            await loop.run_in_executor(None, self.journal.clear)
+        if bundles is not None:
+            total_bundles = len(bundles)
+        else:
+            # As in DSSExtractor.extract(), listings of all bundles replace the previous ones once the extraction
+            # completes.
+            total_bundles = await loop.run_in_executor(None, functools.partial(self.count_bundles, query=query,
+                                                                               resume=resume, deferred=True))
+            if query is not None and total_bundles == 0:
+                logger.error("No bundles found, nothing to do")
+                return dict(total_bundles=0, extracted_bundles=0, failed_bundles=0, elapsed_seconds=time.time() - start)
+        logger.info("Scanning %s bundles", total_bundles)
+
+        def finish(bundle_uuid, bundle_version):
+            self.journal.record(bundle_uuid, bundle_version, CheckpointJournal.LOADED)
+            self.errors.resolve(bundle_uuid, bundle_version)
+
+        extracted_bundle_count, error_bundle_count = 0, 0
+        pages = collections.deque()
+        # Maps each pending task to the page of its bundle
+        in_flight = {}
+        connector = aiohttp.TCPConnector(limit=max_connections)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_transform_workers) as transform_executor:
+            async with aiohttp.ClientSession(connector=connector, timeout=self.timeout_policy) as session:
+                bundle_pages = self.page_bundles(query=query, replica="aws", page_size=page_size, bundles=bundles)
+                page_bundles, exhausted = collections.deque(), False
+                try:
+                    while True:
+                        # New bundles are dispatched as soon as earlier ones complete, even across page boundaries.
+                        while not exhausted and len(in_flight) < max_bundles_in_flight:
+                            if not page_bundles:
+                                next_page = await loop.run_in_executor(None, self._next_page_bundles, bundle_pages,
+                                                                       resume)
+                                if next_page is None:
+                                    exhausted = True
+                                    break
+                                page, page_bundles = _PageState(), collections.deque(next_page)
+                                page.dispatched = not page_bundles
+                                pages.append(page)
+                                continue
+                            bundle = page_bundles.popleft()
+                            task = self._extract_transform_one(session, transform_executor, bundle["uuid"],
+                                                               bundle["version"], transformer)
+                            in_flight[asyncio.ensure_future(task)] = page
+                            page.pending += 1
+                            page.dispatched = not page_bundles
+                        while pages and pages[0].done:
+                            logger.info(f"Extracted bundles: {extracted_bundle_count} "
+                                        f"({extracted_bundle_count/max(total_bundles, 1):.1%}, "
+                                        f"{error_bundle_count} errors)")
+                            if page_processor is not None:
+                                await loop.run_in_executor(None, page_processor, pages[0].results)
+                            pages.popleft()
+                        if not in_flight:
+                            break
+                        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            page = in_flight.pop(task)
+                            try:
+                                bundle_uuid, bundle_version, result = task.result()
+                            except Exception:
+                                error_bundle_count += 1
+                                self.metrics.increment("bundles_failed")
+                                page.pending -= 1
+                                if self._continue_on_bundle_extract_errors:
+                                    continue
+                                else:
+                                    raise
+                            page.results.append(result)
+                            extracted_bundle_count += 1
+                            self.metrics.increment("bundles_extracted")
+                            if loader is not None and result is not None:
+                                await loop.run_in_executor(None, functools.partial(loader, bundle=result))
+                            await loop.run_in_executor(None, finish, bundle_uuid, bundle_version)
+                            page.pending -= 1
+                finally:
+                    for task in in_flight:
+                        task.cancel()
+        if query is None and bundles is None:
+            await loop.run_in_executor(None, self._promote_bundle_lists)
+        end = time.time()
+        logger.info(f"Processed {total_bundles} bundles in {round(end - start)} seconds")
+        logger.info(f"Successfully extracted {extracted_bundle_count} bundles")
+        logger.info(f"Failures in {error_bundle_count} bundles (see {self.staging.db_path})")
+        return dict(total_bundles=total_bundles, extracted_bundles=extracted_bundle_count,
+                    failed_bundles=error_bundle_count, elapsed_seconds=end - start)
+
+    def _next_page_bundles(self, pages, resume):
+        """
+        Returns the bundles of the next page from page_bundles(), or None after the last page. When resuming, bundles
+        already loaded are left out.
+        """
+        page = next(pages, None)
+        if page is None:
+            return None
+        page_bundles = []
+        for bundle in page['results'] if 'results' in page else page:
+            if "bundle_fqid" in bundle:
+                bundle["uuid"], bundle["version"] = bundle["bundle_fqid"].split(".", 1)
+            if resume and self.journal.state(bundle["uuid"], bundle["version"]) == CheckpointJournal.LOADED:
+                continue
+            page_bundles.append(bundle)
+        return page_bundles
+
+    async def _extract_transform_one(self, session, transform_executor, bundle_uuid, bundle_version, transformer):
+        loop = asyncio.get_event_loop()
+        try:
+            await self.get_files_to_fetch_for_bundle_async(session, bundle_uuid, bundle_version)
+            result = await loop.run_in_executor(
+                transform_executor, self._transform_one, bundle_uuid, bundle_version, transformer
+            )
+        except Exception as e:
+            await loop.run_in_executor(None, self._record_failure, bundle_uuid, bundle_version, e)
+            raise
+        return bundle_uuid, bundle_version, result
+
+    def _record_failure(self, bundle_uuid, bundle_version, e):
+        self.errors.record(bundle_uuid, bundle_version, "extract_transform", e)
+        self.journal.record(bundle_uuid, bundle_version, CheckpointJournal.FAILED)
+
+    async def _get(self, session, url, params=None):
+        """
+        Returns the response to a GET request, following redirects (honoring Retry-After) and retrying throttled
+        requests and server errors with exponential backoff. The caller must release the response.
+        """
+        retries, redirects = 0, 0
+        while True:
+            try:
+                res = await session.get(url, params=params, allow_redirects=False)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                await asyncio.sleep(self.backoff_factor * 2 ** retries)
+                continue
+            if res.status in {301, 302, 303, 307, 308} and "Location" in res.headers:
+                res.release()
+                redirects += 1
+                if redirects > self.max_redirects:
+                    raise aiohttp.ClientError(f"Exceeded {self.max_redirects} redirects for {url}")
+                if "Retry-After" in res.headers:
+                    logger.debug("Waiting %ss before redirect per Retry-After header", res.headers["Retry-After"])
+                    await asyncio.sleep(self._retry_after(res, 0))
+                url, params = res.url.join(URL(res.headers["Location"])), None
+                continue
+            if res.status in self.retry_status_codes and retries < self.max_retries:
+                res.release()
+                retries += 1
+                await asyncio.sleep(self._retry_after(res, self.backoff_factor * 2 ** retries))
+                continue
+            if res.status >= 400:
+                res.release()
+                res.raise_for_status()
+            return res
+
+    @staticmethod
+    def _retry_after(res, default):
+        try:
+            return float(res.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return default
+
+    async def get_files_to_fetch_for_bundle_async(self, session, bundle_uuid, bundle_version):
+        loop = asyncio.get_event_loop()
+        fetches = []
+
+        def fetch_files(manifest_files):
+            # Files start being fetched as soon as the manifest page listing them arrives.
+            for f in manifest_files:
+                if not self._should_fetch_file(f):
+                    logger.debug("Skipping file %s/%s (no filter match)", bundle_uuid, f["name"])
+                else:
+                    fetch = self._fetch_file_if_not_cached_async(session, f, bundle_uuid, bundle_version)
+                    fetches.append((f, asyncio.ensure_future(fetch)))
+
+        try:
+            bundle_manifest = await loop.run_in_executor(None, self.staging.load_manifest, bundle_uuid, bundle_version)
+            if bundle_manifest is not None:
+                fetch_files(bundle_manifest["files"])
+            else:
+                logger.debug("Fetching manifest for bundle %s", bundle_uuid)
+                try:
+                    res = await self._get(session, f"{self.dss_client.host}/bundles/{bundle_uuid}",
+                                          params={"replica": "aws", "version": bundle_version})
+                except Exception as e:
+                    await loop.run_in_executor(None, self._record_error, "manifest", bundle_uuid, bundle_version, e)
+                    raise
+                async with res:
+                    bundle_manifest = (await res.json())["bundle"]
+                fetch_files(list(bundle_manifest["files"]))
+                while res.links.get("next", {}).get("url"):
+                    res = await self._get(session, res.links["next"]["url"])
+                    async with res:
+                        manifest_files = (await res.json())["bundle"]["files"]
+                    bundle_manifest["files"].extend(manifest_files)
+                    fetch_files(manifest_files)
+                await loop.run_in_executor(None, self.staging.save_manifest, bundle_uuid, bundle_version,
+                                           bundle_manifest)
+        except BaseException:
+            for f, fetch in fetches:
+                fetch.cancel()
+            raise
+        results = await asyncio.gather(*(fetch for f, fetch in fetches), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        fetched_files = [f for (f, fetch), fetched in zip(fetches, results) if fetched]
+        return bundle_uuid, bundle_version, fetched_files
+
+    async def _fetch_file_if_not_cached_async(self, session, f, bundle_uuid, bundle_version):
+        """
+        Like DSSExtractor._fetch_file_if_not_cached(), but fetches the file with get_file_async().
+        """
+        loop = asyncio.get_event_loop()
+        if await loop.run_in_executor(None, self._is_cached, f, bundle_uuid, bundle_version):
+            await loop.run_in_executor(None, self.staging.link_file, bundle_uuid, bundle_version, f)
+            return False
+        await self.get_file_async(session, f, bundle_uuid, bundle_version)
+        await loop.run_in_executor(None, self._update_cached_size, f)
+        return True
+
+    async def get_file_async(self, session, f, bundle_uuid, bundle_version):
+        logger.debug("Fetching %s:%s", bundle_uuid, f["name"])
+        loop = asyncio.get_event_loop()
+        fetch_start, file_size = time.perf_counter(), 0
+        try:
+            res = await self._get(session, f"{self.dss_client.host}/files/{f['uuid']}",
+                                  params={"replica": "aws", "version": f["version"]})
+        except Exception as e:
+            await loop.run_in_executor(None, self._record_error, "file", bundle_uuid, bundle_version, e, f)
+            raise
+        tmp_file_path = self.staging.tmp_file_path(f)
+        sink = ChecksummingSink(self._download_chunk_size, hash_functions=("sha256",))
+
+        def write(fh, chunk):
+            sink.write(chunk)
+            fh.write(chunk)
+
+        try:
+            fh = await loop.run_in_executor(None, open, tmp_file_path, "wb")
+            try:
+                async for chunk in res.content.iter_chunked(self._download_chunk_size):
+                    await loop.run_in_executor(None, write, fh, chunk)
+                    file_size += len(chunk)
+            finally:
+                await loop.run_in_executor(None, fh.close)
+            file_csum = (await loop.run_in_executor(None, sink.get_checksums))["sha256"]
+            if file_csum != f["sha256"]:
+                raise ChecksumMismatch(f"{bundle_uuid}.{bundle_version}/{f['uuid']}.{f['version']} {f['name']}: "
+                                       f"expected sha256 {f['sha256']}, got {file_csum}")
+        except BaseException:
+            if os.path.exists(tmp_file_path):
+                os.unlink(tmp_file_path)
+            raise
+        finally:
+            res.release()
+        await loop.run_in_executor(None, self.staging.commit_file, tmp_file_path, f)
+        await loop.run_in_executor(None, self.staging.link_file, bundle_uuid, bundle_version, f)
+        self.metrics.observe("file_fetch", time.perf_counter() - fetch_start)
+        self.metrics.increment("files_fetched")
+        self.metrics.increment("bytes_fetched", file_size)
+        logger.debug("Wrote %s:%s", bundle_uuid, f["name"])
+        return f, bundle_uuid, bundle_version
@@ -0,0 +1,124 @@
+"""
+Read access to staged bundles for transformers.
+
+A transformer can call extractor.bundle_view(bundle_uuid, bundle_version) to get a BundleView of the bundle it was
+passed, instead of opening and reading the files under bundle_path itself:
+
+    def tf(bundle_uuid, bundle_version, bundle_path, bundle_manifest_path, extractor):
+        with extractor.bundle_view(bundle_uuid, bundle_version) as bundle:
+            project = bundle.json("project_0.json")
+            header = bytes(bundle.buffer("reads.fastq.gz")[:16])
+
+buffer() returns a read-only memoryview of a memory-mapped file, which is not copied unless sliced into bytes. json()
+parses a file on first access and caches the document by its sha256 in a DocumentCache shared by all bundles of the
+extractor, so metadata documents that appear in many bundles are parsed once. Cached documents are shared between
+bundles and must not be modified.
+"""
+
+import os, json, mmap, threading, collections, collections.abc
+
+
+class DocumentCache:
+    """
+    A thread-safe LRU cache of up to max_entries parsed documents.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._documents = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._documents:
+                self._documents.move_to_end(key)
+                self.hits += 1
+                return self._documents[key]
+            self.misses += 1
+        document = load()
+        with self._lock:
+            self._documents[key] = document
+            while len(self._documents) > self.max_entries:
+                self._documents.popitem(last=False)
+        return document
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __getstate__(self):
+        return dict(max_entries=self.max_entries)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class BundleView(collections.abc.Mapping):
+    """
+    A read-only mapping of the names of the files staged for a bundle to their memory-mapped contents. Files are read
+    from the bundle directory, or from file_paths, a map from the name of each file to its path, if it is given.
+    """
+    def __init__(self, bundle_path, bundle_manifest=None, document_cache: DocumentCache = None, file_paths=None):
+        self.bundle_path = bundle_path
+        self.file_paths = file_paths
+        self.manifest = bundle_manifest
+        self._files = {f["name"]: f for f in bundle_manifest["files"]} if bundle_manifest else {}
+        self._document_cache = document_cache
+        self._mmaps = {}
+
+    def __iter__(self):
+        if self.file_paths is not None:
+            return iter(sorted(self.file_paths))
+        if self.bundle_path is None or not os.path.isdir(self.bundle_path):
+            return iter(())
+        return iter(sorted(os.listdir(self.bundle_path)))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, name):
+        if self.file_paths is not None:
+            return name in self.file_paths
+        return self.bundle_path is not None and os.path.exists(os.path.join(self.bundle_path, name))
+
+    def __getitem__(self, name):
+        return self.buffer(name)
+
+    def buffer(self, name):
+        """
+        Returns a read-only memoryview of the contents of the named file.
+        """
+        if name not in self._mmaps:
+            path = self.file_paths[name] if self.file_paths is not None else os.path.join(self.bundle_path, name)
+            with open(path, "rb") as fh:
+                if os.fstat(fh.fileno()).st_size == 0:
+                    return memoryview(b"")
+                self._mmaps[name] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmaps[name])
+
+    def json(self, name):
+        """
+        Returns the parsed JSON document in the named file. Documents are cached by the sha256 of the file listed in
+        the bundle manifest, if there is one.
+        """
+        def load():
+            with self.buffer(name) as buf:
+                return json.loads(bytes(buf))
+        sha256 = self._files.get(name, {}).get("sha256")
+        if self._document_cache is None or sha256 is None:
+            return load()
+        return self._document_cache.get(sha256, load)
+
+    def close(self):
+        for name, mm in list(self._mmaps.items()):
+            try:
+                mm.close()
+            except BufferError:
+                # A buffer returned by buffer() is still in use; the mapping is closed when it is garbage collected.
+                continue
+            del self._mmaps[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,175 @@
+"""
+Size limits for the DSSExtractor staging directory.
+
+StagingCache tracks which staged files (including manifests) each bundle uses, and when and how often each bundle was
+last extracted. When the staged files exceed max_bytes, or the staged bundles exceed max_bundles, whole bundles are
+evicted in least recently used ("lru") or least frequently used ("lfu") order: the bundle directory is removed, and
+each file is deleted once no remaining bundle uses it, so bundle directories never hold dangling links to evicted
+files. Bundles that are being extracted are pinned and never evicted. When shards of an extraction share a staging
+directory, each shard only evicts its own bundles, as it cannot tell which bundles of other shards are being extracted;
+files are only deleted once no bundle of any shard uses them.
+
+Only bundles extracted while the cache is enabled are tracked; anything staged before is left in place. Eviction
+candidates are read from an index in batches of eviction_batch_size, and only until the cache is back within its
+budget, so the cost of eviction does not grow with the number of tracked bundles.
+"""
+
+import os, time
+
+from .stores import SQLiteStore
+
+
+class StagingCache(SQLiteStore):
+    LRU, LFU = "lru", "lfu"
+    eviction_batch_size = 64
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS cache_bundles (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            use_count INTEGER NOT NULL,
+            PRIMARY KEY (uuid, version)
+        );
+        CREATE INDEX IF NOT EXISTS cache_bundles_lru ON cache_bundles (last_used);
+        CREATE INDEX IF NOT EXISTS cache_bundles_lfu ON cache_bundles (use_count, last_used);
+        CREATE TABLE IF NOT EXISTS cache_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cache_refs (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (uuid, version, path)
+        );
+        CREATE INDEX IF NOT EXISTS cache_refs_path ON cache_refs (path);
+        CREATE TABLE IF NOT EXISTS cache_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            bytes INTEGER NOT NULL,
+            bundles INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO cache_totals VALUES (0, 0, 0);
+        CREATE TRIGGER IF NOT EXISTS cache_files_insert AFTER INSERT ON cache_files BEGIN
+            UPDATE cache_totals SET bytes = bytes + new.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS cache_files_update AFTER UPDATE OF size ON cache_files BEGIN
+            UPDATE cache_totals SET bytes = bytes - old.size + new.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS cache_files_delete AFTER DELETE ON cache_files BEGIN
+            UPDATE cache_totals SET bytes = bytes - old.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS cache_bundles_insert AFTER INSERT ON cache_bundles BEGIN
+            UPDATE cache_totals SET bundles = bundles + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS cache_bundles_delete AFTER DELETE ON cache_bundles BEGIN
+            UPDATE cache_totals SET bundles = bundles - 1;
+        END;
+    """
+
+    def __init__(self, staging_area, max_bytes=None, max_bundles=None, policy=LRU):
+        if policy not in {self.LRU, self.LFU}:
+            raise ValueError(f"Unknown cache eviction policy {policy}")
+        super().__init__(staging_area.db_path)
+        self.staging = staging_area
+        self.max_bytes = max_bytes
+        self.max_bundles = max_bundles
+        self.policy = policy
+
+    def touch(self, bundle_uuid, bundle_version):
+        """
+        Records a use of the bundle.
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("INSERT OR IGNORE INTO cache_bundles VALUES (?, ?, 0, 0)", (bundle_uuid, bundle_version))
+            self.db.execute("UPDATE cache_bundles SET last_used=?, use_count=use_count + 1 WHERE uuid=? AND version=?",
+                            (time.time(), bundle_uuid, bundle_version))
+
+    def add_file(self, bundle_uuid, bundle_version, path, size=None):
+        """
+        Records that the bundle uses the staged file at path. This must be called before checking whether the file is
+        staged, so that the file cannot be evicted between the check and its use. If size is not known, it is set
+        from the file once it has been staged, with update_size().
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("INSERT OR IGNORE INTO cache_refs VALUES (?, ?, ?)", (bundle_uuid, bundle_version, path))
+            self.db.execute("INSERT OR IGNORE INTO cache_files VALUES (?, ?)", (path, size or 0))
+
+    def update_size(self, path):
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        self.db.execute("UPDATE cache_files SET size=? WHERE path=? AND size != ?", (size, path, size))
+
+    def totals(self):
+        """
+        Returns the number of bytes and bundles tracked by the cache.
+        """
+        return self.db.execute("SELECT bytes, bundles FROM cache_totals").fetchone()
+
+    def over_budget(self):
+        total_bytes, total_bundles = self.totals()
+        if self.max_bytes is not None and total_bytes > self.max_bytes:
+            return True
+        return self.max_bundles is not None and total_bundles > self.max_bundles
+
+    def evict(self, pinned=frozenset(), shard_index=0, shard_count=1):
+        """
+        Evicts bundles of the given shard until the cache is within its budget, skipping the (uuid, version) pairs in
+        pinned. Returns the evicted bundles.
+        """
+        evicted = []
+        if not self.over_budget():
+            return evicted
+        for bundle_uuid, bundle_version in self._eviction_candidates():
+            if (bundle_uuid, bundle_version) in pinned or int(bundle_uuid[:2], 16) % shard_count != shard_index:
+                continue
+            self.evict_bundle(bundle_uuid, bundle_version)
+            evicted.append((bundle_uuid, bundle_version))
+            if not self.over_budget():
+                break
+        return evicted
+
+    def _eviction_candidates(self):
+        """
+        Yields the tracked bundles in eviction order. Bundles are read in batches, each starting after the last bundle
+        of the previous batch, as the caller usually stops after the first few.
+        """
+        order = "last_used, rowid" if self.policy == self.LRU else "use_count, last_used, rowid"
+        key_length = len(order.split(", "))
+        query = f"SELECT {order}, uuid, version FROM cache_bundles"
+        rows = self.db.execute(f"{query} ORDER BY {order} LIMIT ?", (self.eviction_batch_size,)).fetchall()
+        while rows:
+            for row in rows:
+                yield row[key_length:]
+            if len(rows) < self.eviction_batch_size:
+                return
+            last_key = rows[-1][:key_length]
+            placeholders = ", ".join("?" * key_length)
+            rows = self.db.execute(f"{query} WHERE ({order}) > ({placeholders}) ORDER BY {order} LIMIT ?",
+                                   last_key + (self.eviction_batch_size,)).fetchall()
+
+    def evict_bundle(self, bundle_uuid, bundle_version):
+        """
+        Removes the bundle directory, and deletes the files used by the bundle that no other bundle uses.
+        """
+        self.staging.remove_bundle(bundle_uuid, bundle_version)
+        # Files are deleted while the write lock is held, so that add_file() for another bundle either completes
+        # first, keeping the file, or waits until the file is gone and will be fetched again.
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            bundle = (bundle_uuid, bundle_version)
+            rows = self.db.execute("SELECT path FROM cache_refs WHERE uuid=? AND version=?", bundle).fetchall()
+            paths = [path for path, in rows]
+            self.db.execute("DELETE FROM cache_refs WHERE uuid=? AND version=?", bundle)
+            self.db.execute("DELETE FROM cache_bundles WHERE uuid=? AND version=?", bundle)
+            for path in paths:
+                if self.db.execute("SELECT 1 FROM cache_refs WHERE path=? LIMIT 1", (path,)).fetchone() is None:
+                    self.db.execute("DELETE FROM cache_files WHERE path=?", (path,))
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
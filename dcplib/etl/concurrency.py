@@ -0,0 +1,105 @@
+"""
+Adaptive concurrency for DSSExtractor.
+
+AdaptiveConcurrencyLimiter adjusts the number of bundles DSSExtractor.extract() keeps in flight to what DSS can
+sustain, with an additive increase, multiplicative decrease (AIMD) policy driven by the responses to the extractor's
+HTTP requests: each successful response below latency_target raises the limit by about increase per limit responses
+(roughly increase per round trip of all bundles in flight), while each 429 or 503 response, or response slower than
+latency_target, lowers it by decrease_factor, at most once per decrease_interval seconds. A Retry-After header on a
+429 or 503 response also stops new bundles from being dispatched until it has passed. The limit stays within
+[min_limit, max_limit].
+
+Responses are observed through response and retry hooks on the extractor's HTTPRequest client (see
+dcplib.networking.HTTPRequest), so that throttling responses that are retried by the client are seen too. Requests
+made through the DSS API client, such as searches and bundle listings, are not observed.
+"""
+
+import time, threading, email.utils
+
+
+class AdaptiveConcurrencyLimiter:
+    throttling_status_codes = frozenset({429, 503})
+
+    def __init__(self, min_limit=1, max_limit=512, initial_limit=None, latency_target=None, increase=1,
+                 decrease_factor=0.5, decrease_interval=1):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("Concurrency limits must satisfy 1 <= min_limit <= max_limit")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self._limit = float(min(max(initial_limit or min_limit, min_limit), max_limit))
+        self._last_decrease = 0
+        self._retry_after = 0
+        self._lock = threading.Lock()
+        self.throttled = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def retry_delay(self):
+        """
+        Returns the number of seconds left before a Retry-After header received with a throttling response has passed.
+        """
+        return max(self._retry_after - time.time(), 0)
+
+    def observe(self, latency=None, status_code=None, retry_after=None):
+        """
+        Adjusts the limit for a response received after latency seconds, if known.
+        """
+        throttled = status_code in self.throttling_status_codes
+        with self._lock:
+            now = time.time()
+            if throttled:
+                self.throttled += 1
+                if retry_after is not None:
+                    self._retry_after = max(self._retry_after, now + retry_after)
+            slow = latency is not None and self.latency_target is not None and latency > self.latency_target
+            if throttled or slow:
+                # Responses to requests made before the last decrease do not reflect it yet
+                if now - self._last_decrease >= self.decrease_interval:
+                    self._limit = max(self._limit * self.decrease_factor, self.min_limit)
+                    self._last_decrease = now
+            elif status_code is None or status_code < 500:
+                self._limit = min(self._limit + self.increase / self._limit, self.max_limit)
+
+    def response_hook(self, res, *args, **kwargs):
+        """
+        A requests response hook that observes the latency, status and Retry-After header of each response.
+        """
+        self.observe(res.elapsed.total_seconds(), res.status_code, parse_retry_after(res.headers.get("Retry-After")))
+
+    def retry_hook(self, response):
+        """
+        A dcplib.networking.Retry hook that observes the status and Retry-After header of each retried response.
+        """
+        self.observe(status_code=response.status, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds to wait given by a Retry-After header value, which is either a number of seconds or
+    an HTTP date, or None if there is no valid value.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,100 @@
+"""
+Instrumentation for DSSExtractor.
+
+ExtractionMetrics collects counters and latency histograms for each stage of an extraction (manifest fetch, file
+fetch, checksum, transform and load), from which snapshot() derives throughput rates. DSSExtractor.extract() passes
+snapshots to a metrics_callback and writes them to a JSON status file at regular intervals.
+
+Stages that run in a process pool (for example, transforms with transform_executor_class=ProcessPoolExecutor) are
+recorded by the worker processes' copies of the metrics, and are not reflected in the snapshots of the calling
+process.
+"""
+
+import os, json, bisect, collections, contextlib, threading, time, uuid
+
+
+class ExtractionMetrics:
+    # Upper bounds, in seconds, of the latency histogram buckets. The last bucket counts all slower operations.
+    latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time.time()
+            self.counters = collections.Counter()
+            self._latency_counts = collections.defaultdict(lambda: [0] * (len(self.latency_buckets) + 1))
+            self._latency_totals = collections.Counter()
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._latency_counts[stage][bisect.bisect_left(self.latency_buckets, seconds)] += 1
+            self._latency_totals[stage] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Records the time spent in the body of the with statement as a latency of stage, whether or not it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage, fn):
+        """
+        Returns a function that calls fn and records its latency as a latency of stage.
+        """
+        def timed_fn(*args, **kwargs):
+            with self.timer(stage):
+                return fn(*args, **kwargs)
+        return timed_fn
+
+    def snapshot(self):
+        """
+        Returns a JSON-serializable dictionary of all counters, per-stage latency statistics and histograms, and
+        rates per second since the metrics were last reset.
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.start, 1e-9)
+            stages = {}
+            for stage, counts in self._latency_counts.items():
+                count = sum(counts)
+                bounds = [str(b) for b in self.latency_buckets] + ["inf"]
+                stages[stage] = dict(count=count,
+                                     total_seconds=self._latency_totals[stage],
+                                     mean_seconds=self._latency_totals[stage] / count if count else 0,
+                                     histogram=dict(zip(bounds, counts)))
+            counters = dict(self.counters)
+        rates = dict(bundles_per_second=counters.get("bundles_extracted", 0) / elapsed,
+                     files_per_second=counters.get("files_fetched", 0) / elapsed,
+                     bytes_per_second=counters.get("bytes_fetched", 0) / elapsed)
+        return dict(timestamp=time.time(), elapsed_seconds=elapsed, counters=counters, stages=stages, rates=rates)
+
+    def write_status(self, path):
+        """
+        Atomically writes a snapshot to path as JSON.
+        """
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self.snapshot(), fh, indent=2)
+        os.replace(tmp_path, path)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        state["_latency_counts"] = dict(self._latency_counts)
+        return state
+
+    def __setstate__(self, state):
+        latency_counts = state.pop("_latency_counts")
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._latency_counts = collections.defaultdict(lambda: [0] * (len(self.latency_buckets) + 1), latency_counts)
@@ -0,0 +1,228 @@
+"""
+Layouts of the DSSExtractor staging directory.
+
+StagingArea is the default layout: one JSON file per manifest under bundle_manifests/, one file per (uuid, version)
+under files/, and a symlink per staged file under bundles/<uuid>.<version>/. ContentAddressedStagingArea stores files
+once per distinct sha256 under blobs/ and manifests in the staging database, and can record the files staged for each
+bundle in the database instead of in bundle directories, so that the number of inodes and directory entries does not
+grow with the number of bundles on large scans.
+"""
+
+import os, json, shutil, uuid
+
+from ..checksumming_io import ChecksummingSink
+from .stores import SQLiteStore, ChecksumStore
+
+
+class StagingArea:
+    def __init__(self, staging_directory, chunk_size=1024 * 1024):
+        self.sd = staging_directory
+        self.chunk_size = chunk_size
+        self.db_path = f"{self.sd}/staging.db"
+        self._checksums = ChecksumStore(self.db_path)
+
+    def bundle_path(self, bundle_uuid, bundle_version):
+        return f"{self.sd}/bundles/{bundle_uuid}.{bundle_version}"
+
+    def manifest_path(self, bundle_uuid, bundle_version):
+        return f"{self.sd}/bundle_manifests/{bundle_uuid}.{bundle_version}.json"
+
+    def load_manifest(self, bundle_uuid, bundle_version):
+        try:
+            with open(self.manifest_path(bundle_uuid, bundle_version)) as fh:
+                return json.load(fh)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+    def save_manifest(self, bundle_uuid, bundle_version, bundle_manifest):
+        os.makedirs(f"{self.sd}/bundle_manifests", exist_ok=True)
+        with open(self.manifest_path(bundle_uuid, bundle_version), "w") as fh:
+            json.dump(bundle_manifest, fh)
+
+    def file_path(self, f):
+        return f"{self.sd}/files/{f['uuid']}.{f['version']}"
+
+    def tmp_file_path(self, f):
+        file_path = self.file_path(f)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return f"{file_path}.{uuid.uuid4().hex}.tmp"
+
+    def is_cached(self, f):
+        file_path = self.file_path(f)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+        if self._checksums.get(f["uuid"], f["version"], st.st_size, st.st_mtime_ns) == f["sha256"]:
+            return True
+        # Files staged without a checksum record are verified once here, then trusted until they change on disk.
+        sink = ChecksummingSink(self.chunk_size, hash_functions=("sha256",))
+        with open(file_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(self.chunk_size), b""):
+                sink.write(chunk)
+        if sink.get_checksums()["sha256"] != f["sha256"]:
+            return False
+        self._checksums.put(f["uuid"], f["version"], st.st_size, st.st_mtime_ns, f["sha256"])
+        return True
+
+    def commit_file(self, tmp_file_path, f):
+        """
+        Moves a downloaded file whose checksum has been verified into place.
+        """
+        file_path = self.file_path(f)
+        os.replace(tmp_file_path, file_path)
+        st = os.stat(file_path)
+        self._checksums.put(f["uuid"], f["version"], st.st_size, st.st_mtime_ns, f["sha256"])
+
+    def link_file(self, bundle_uuid, bundle_version, f):
+        bundle_path = self.bundle_path(bundle_uuid, bundle_version)
+        link_path = f"{bundle_path}/{f['name']}"
+        if not os.path.lexists(link_path):
+            os.makedirs(bundle_path, exist_ok=True)
+            try:
+                os.symlink(os.path.relpath(self.file_path(f), bundle_path), link_path)
+            except FileExistsError:
+                pass
+
+    def staged_files(self, bundle_uuid, bundle_version):
+        """
+        Returns a map from the name of each file staged for the bundle to its path, or None if the files are to be
+        found in the bundle directory.
+        """
+        return None
+
+    def is_staged(self, bundle_uuid, bundle_version):
+        """
+        Returns True if any files have been staged for the bundle.
+        """
+        return os.path.exists(self.bundle_path(bundle_uuid, bundle_version))
+
+    def remove_bundle(self, bundle_uuid, bundle_version):
+        """
+        Forgets the files staged for the bundle. The files themselves are left in place.
+        """
+        shutil.rmtree(self.bundle_path(bundle_uuid, bundle_version), ignore_errors=True)
+
+
+class BundleIndex(SQLiteStore):
+    """
+    The manifests of the bundles staged by a ContentAddressedStagingArea, and the files staged for each bundle.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS staged_manifests (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            body TEXT NOT NULL,
+            PRIMARY KEY (uuid, version)
+        );
+        CREATE TABLE IF NOT EXISTS staged_files (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            name TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (uuid, version, name)
+        );
+    """
+
+    def get_manifest(self, uuid, version):
+        row = self.db.execute("SELECT body FROM staged_manifests WHERE uuid=? AND version=?",
+                              (uuid, version)).fetchone()
+        return row[0] if row else None
+
+    def put_manifest(self, uuid, version, body):
+        self.db.execute("INSERT OR REPLACE INTO staged_manifests VALUES (?, ?, ?)", (uuid, version, body))
+
+    def add_file(self, uuid, version, name, sha256):
+        self.db.execute("INSERT OR REPLACE INTO staged_files VALUES (?, ?, ?, ?)", (uuid, version, name, sha256))
+
+    def files(self, uuid, version):
+        """
+        Returns a map from the name of each file staged for the bundle to its sha256.
+        """
+        return dict(self.db.execute("SELECT name, sha256 FROM staged_files WHERE uuid=? AND version=?",
+                                    (uuid, version)))
+
+    def remove_files(self, uuid, version):
+        self.db.execute("DELETE FROM staged_files WHERE uuid=? AND version=?", (uuid, version))
+
+
+class ContentAddressedStagingArea(StagingArea):
+    """
+    Stores each distinct file once, under blobs/<sha256[:2]>/<sha256>, so files shared by many bundles (such as
+    identical metadata documents) are fetched and stored once. A blob is only moved into place after its checksum has
+    been verified, so its presence is enough to trust it. Manifests are stored in the staging database.
+
+    By default, bundles/<uuid>.<version>/ still holds a symlink per staged file, and each manifest is written to
+    bundle_manifests/ the first time its path is requested, so that bundle_path and bundle_manifest_path can be read by
+    transformers as with StagingArea. Even so, each bundle still uses a directory, a symlink per file and a manifest
+    file. With bundle_directories=False, no per-bundle files or directories are created: the files staged for each
+    bundle are recorded in the staging database, transformers are passed None for bundle_path and
+    bundle_manifest_path, and read bundles through extractor.bundle_view() and extractor.staging.load_manifest()
+    instead. To use it, pass functools.partial(ContentAddressedStagingArea, bundle_directories=False) as the
+    staging_area_class of DSSExtractor.
+    """
+    def __init__(self, staging_directory, chunk_size=1024 * 1024, bundle_directories=True):
+        super().__init__(staging_directory, chunk_size=chunk_size)
+        self.bundle_directories = bundle_directories
+        self._index = BundleIndex(self.db_path)
+
+    def _blob_path(self, sha256):
+        return f"{self.sd}/blobs/{sha256[:2]}/{sha256}"
+
+    def bundle_path(self, bundle_uuid, bundle_version):
+        if not self.bundle_directories:
+            return None
+        return super().bundle_path(bundle_uuid, bundle_version)
+
+    def manifest_path(self, bundle_uuid, bundle_version):
+        if not self.bundle_directories:
+            return None
+        manifest_path = super().manifest_path(bundle_uuid, bundle_version)
+        if not os.path.exists(manifest_path):
+            body = self._index.get_manifest(bundle_uuid, bundle_version)
+            if body is not None:
+                os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+                tmp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "w") as fh:
+                    fh.write(body)
+                os.replace(tmp_path, manifest_path)
+        return manifest_path
+
+    def load_manifest(self, bundle_uuid, bundle_version):
+        body = self._index.get_manifest(bundle_uuid, bundle_version)
+        return json.loads(body) if body is not None else None
+
+    def save_manifest(self, bundle_uuid, bundle_version, bundle_manifest):
+        self._index.put_manifest(bundle_uuid, bundle_version, json.dumps(bundle_manifest))
+
+    def file_path(self, f):
+        return self._blob_path(f["sha256"])
+
+    def is_cached(self, f):
+        return os.path.exists(self.file_path(f))
+
+    def commit_file(self, tmp_file_path, f):
+        os.replace(tmp_file_path, self.file_path(f))
+
+    def link_file(self, bundle_uuid, bundle_version, f):
+        if self.bundle_directories:
+            super().link_file(bundle_uuid, bundle_version, f)
+        else:
+            self._index.add_file(bundle_uuid, bundle_version, f["name"], f["sha256"])
+
+    def staged_files(self, bundle_uuid, bundle_version):
+        if self.bundle_directories:
+            return None
+        files = self._index.files(bundle_uuid, bundle_version)
+        return {name: self._blob_path(sha256) for name, sha256 in files.items()}
+
+    def is_staged(self, bundle_uuid, bundle_version):
+        if self.bundle_directories:
+            return super().is_staged(bundle_uuid, bundle_version)
+        return bool(self._index.files(bundle_uuid, bundle_version))
+
+    def remove_bundle(self, bundle_uuid, bundle_version):
+        if self.bundle_directories:
+            super().remove_bundle(bundle_uuid, bundle_version)
+        else:
+            self._index.remove_files(bundle_uuid, bundle_version)
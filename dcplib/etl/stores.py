@@ -0,0 +1,186 @@
+"""
+Persistent ETL state, kept in a SQLite database in the DSSExtractor staging directory.
+"""
+
+import sqlite3, threading, time, traceback
+
+
+class SQLiteStore:
+    """
+    Base class for tables in the staging database.
+
+    Each thread opens its own connection on first use. Connections are not pickled, so stores can be shared by thread
+    pools and sent to process pools along with the DSSExtractor that owns them.
+    """
+    schema = ""
+    setup_retries = 100
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            # Connections from several processes setting up a new database at once can fail with "database is
+            # locked" without waiting for the busy timeout, so setup is retried.
+            for attempt in range(self.setup_retries + 1):
+                try:
+                    db.execute("PRAGMA journal_mode=WAL")
+                    db.execute("PRAGMA synchronous=NORMAL")
+                    db.executescript(self.schema)
+                    break
+                except sqlite3.OperationalError as e:
+                    if "database is locked" not in str(e) or attempt == self.setup_retries:
+                        raise
+                    time.sleep(0.1)
+            self._local.db = db
+        return db
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+
+class ChecksumStore(SQLiteStore):
+    """
+    Records the sha256 of staged files that have been verified, so that a file whose size and mtime have not changed
+    since it was verified can be trusted without being read again.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS verified_files (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (uuid, version)
+        );
+    """
+
+    def get(self, uuid, version, size, mtime_ns):
+        row = self.db.execute("SELECT sha256 FROM verified_files WHERE uuid=? AND version=? AND size=? AND mtime_ns=?",
+                              (uuid, version, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def put(self, uuid, version, size, mtime_ns, sha256):
+        self.db.execute("INSERT OR REPLACE INTO verified_files VALUES (?, ?, ?, ?, ?)",
+                        (uuid, version, size, mtime_ns, sha256))
+
+
+class CheckpointJournal(SQLiteStore):
+    """
+    Records how far each bundle has progressed through an extraction, so that an interrupted extraction can be resumed
+    without revisiting bundles that were completed.
+    """
+    EXTRACTED, TRANSFORMED, LOADED, FAILED = "extracted", "transformed", "loaded", "failed"
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (uuid, version)
+        );
+    """
+
+    def record(self, uuid, version, state):
+        self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)", (uuid, version, state, time.time()))
+
+    def state(self, uuid, version):
+        row = self.db.execute("SELECT state FROM checkpoints WHERE uuid=? AND version=?", (uuid, version)).fetchone()
+        return row[0] if row else None
+
+    def bundles(self, state):
+        for uuid, version in self.db.execute("SELECT uuid, version FROM checkpoints WHERE state=?", (state,)):
+            yield uuid, version
+
+    def clear(self, shard_index=0, shard_count=1):
+        if shard_count == 1:
+            self.db.execute("DELETE FROM checkpoints")
+        else:
+            self.db.create_function("in_shard", 1, lambda uuid: int(uuid[:2], 16) % shard_count == shard_index)
+            self.db.execute("DELETE FROM checkpoints WHERE in_shard(uuid)")
+
+
+class ErrorStore(SQLiteStore):
+    """
+    Records extraction failures, one row per failed bundle or file, with the HTTP status and exception that caused
+    them. Bundles keep their errors until they are extracted successfully, and the number of times a bundle has been
+    retried is recorded with each error.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS errors (
+            id INTEGER PRIMARY KEY,
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            file_uuid TEXT,
+            file_version TEXT,
+            file_name TEXT,
+            http_status INTEGER,
+            exception_type TEXT NOT NULL,
+            message TEXT NOT NULL,
+            traceback TEXT NOT NULL,
+            retries INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS errors_bundle ON errors (uuid, version);
+        CREATE TABLE IF NOT EXISTS bundle_retries (
+            uuid TEXT NOT NULL,
+            version TEXT NOT NULL,
+            retries INTEGER NOT NULL,
+            PRIMARY KEY (uuid, version)
+        );
+    """
+    columns = ("uuid", "version", "stage", "file_uuid", "file_version", "file_name", "http_status", "exception_type",
+               "message", "traceback", "retries", "created")
+
+    def record(self, uuid, version, stage, exception, f=None):
+        response = getattr(exception, "response", None)
+        http_status = getattr(response, "status_code", getattr(response, "status", None))
+        if http_status is None:
+            # aiohttp.ClientResponseError carries the status itself
+            http_status = getattr(exception, "status", None)
+        tb = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+        self.db.execute("INSERT INTO errors (uuid, version, stage, file_uuid, file_version, file_name, http_status, "
+                        "exception_type, message, traceback, retries, created) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                        "(SELECT COALESCE(MAX(retries), 0) FROM bundle_retries WHERE uuid=? AND version=?), ?)",
+                        (uuid, version, stage, f and f["uuid"], f and f["version"], f and f["name"], http_status,
+                         type(exception).__name__, str(exception), tb, uuid, version, time.time()))
+
+    def errors(self, uuid=None, version=None):
+        """
+        Yields the recorded errors as dictionaries, oldest first, optionally only those of one bundle.
+        """
+        query, args = f"SELECT {', '.join(self.columns)} FROM errors", ()
+        if uuid is not None:
+            query, args = query + " WHERE uuid=? AND version=?", (uuid, version)
+        for row in self.db.execute(query + " ORDER BY id", args):
+            yield dict(zip(self.columns, row))
+
+    def failed_bundles(self):
+        for uuid, version in self.db.execute("SELECT DISTINCT uuid, version FROM errors ORDER BY uuid, version"):
+            yield uuid, version
+
+    def count_retry(self, uuid, version):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("INSERT OR IGNORE INTO bundle_retries VALUES (?, ?, 0)", (uuid, version))
+            self.db.execute("UPDATE bundle_retries SET retries=retries + 1 WHERE uuid=? AND version=?", (uuid, version))
+
+    def resolve(self, uuid, version):
+        """
+        Forgets the errors of a bundle that has been extracted successfully.
+        """
+        self.db.execute("DELETE FROM errors WHERE uuid=? AND version=?", (uuid, version))
+        self.db.execute("DELETE FROM bundle_retries WHERE uuid=? AND version=?", (uuid, version))
@@ -24,6 +24,25 @@ class Session(requests.Session):
         for rv in super(Session, self).resolve_redirects(resp, req, **kwargs):
             yield rv
 
+class Retry(retry.Retry):
+    """
+    A urllib3 retry policy that calls each function in hooks with every response that it retries, such as 503
+    responses and 429 responses with a Retry-After header, which are otherwise not seen by the caller.
+    """
+    def __init__(self, *args, hooks=(), **kwargs):
+        super(Retry, self).__init__(*args, **kwargs)
+        self.hooks = hooks
+
+    def new(self, **kwargs):
+        kwargs.setdefault("hooks", self.hooks)
+        return super(Retry, self).new(**kwargs)
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+        if response is not None:
+            for hook in self.hooks:
+                hook(response)
+        return super(Retry, self).increment(method, url, response, *args, **kwargs)
+
 class HTTPRequest:
     """
     A requests wrapper preconfigured with best practice timeout and retry policies and per-thread session tracking.
@@ -32,25 +51,35 @@ class HTTPRequest:
     make the client resistant to both network issues and intermittent server-side errors.
 
     The per-thread session tracking is to avoid many threads sharing the same session in multithreaded environments.
+
+    Functions in response_hooks are called with each response received by any of the sessions, as requests response
+    hooks, and functions in retry_hooks are called with each urllib3 response that is retried before a response is
+    returned. Hooks may be added to either list at any time.
     """
-    retry_policy = retry.Retry(read=4,
-                               status=4,
-                               backoff_factor=0.1,
-                               status_forcelist=frozenset({500, 502, 503, 504}))
+    retry_policy = Retry(read=4,
+                         status=4,
+                         backoff_factor=0.1,
+                         status_forcelist=frozenset({500, 502, 503, 504}))
     timeout_policy = timeout.Timeout(connect=20, read=40)
     codes = requests.codes
 
-    def __init__(self, max_redirects=1024, obey_retry_after=True):
+    def __init__(self, max_redirects=1024, obey_retry_after=True, response_hooks=None, retry_hooks=None):
         self.sessions = {}
         self.max_redirects = max_redirects
         self.obey_retry_after = obey_retry_after
+        self.response_hooks = list(response_hooks or [])
+        self.retry_hooks = list(retry_hooks or [])
 
     def __call__(self, *args, **kwargs):
         if get_ident() not in self.sessions:
             session = Session()
             session.max_redirects = self.max_redirects
             session.obey_retry_after = self.obey_retry_after
-            adapter = HTTPAdapter(max_retries=self.retry_policy)
+            session.hooks["response"] = self.response_hooks
+            retry_policy = self.retry_policy
+            if isinstance(retry_policy, Retry):
+                retry_policy = retry_policy.new(hooks=self.retry_hooks)
+            adapter = HTTPAdapter(max_retries=retry_policy)
             session.mount('http://', adapter)
             session.mount('https://', adapter)
             self.sessions[get_ident()] = session
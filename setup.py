@@ -13,6 +13,9 @@ setup(name='dcplib',
       packages=find_packages(exclude=['tests']),
       zip_safe=False,
       install_requires=install_requires,
+      extras_require={
+          'async': ['aiohttp']
+      },
       platforms=['MacOS X', 'Posix'],
       test_suite='test',
       classifiers=[
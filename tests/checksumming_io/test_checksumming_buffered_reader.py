@@ -40,6 +40,14 @@ class TestChecksummingBufferedReader(unittest.TestCase):
             sums = reader.get_checksums()
             self.check_sums(sums)
 
+    def test_parallel_checksums_after_multiple_reads(self):
+        with io.open(TEST_FILE, 'rb') as raw_fh:
+            with ChecksummingBufferedReader(raw_fh, self.chunk_size, parallel=True) as reader:
+                while reader.read(1024):
+                    pass
+                sums = reader.get_checksums()
+            self.check_sums(sums)
+
 
 if __name__ == '__main__':
     unittest.main()
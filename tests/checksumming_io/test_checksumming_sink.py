@@ -3,7 +3,9 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
 import os
+import random
 import sys
 import unittest
 
@@ -12,7 +14,7 @@ sys.path.insert(0, pkg_root)  # noqa
 
 from dcplib import s3_multipart
 from dcplib.checksumming_io import ChecksummingSink
-from dcplib.checksumming_io._crc32c import CRC32C
+from dcplib.checksumming_io._crc32c import CRC32C, crc32c_combine
 from . import TEST_FILE, TEST_FILE_CHECKSUMS
 
 
@@ -72,6 +74,54 @@ class TestChecksummingSink(unittest.TestCase):
         [self.assertEqual(TEST_FILE_CHECKSUMS[checksum].lower(), sums[checksum].lower()) for checksum in
          checksums_to_compute]
 
+    def test_parallel_checksums_after_multiple_write(self):
+        with ChecksummingSink(self.chunk_size, parallel=True) as sink:
+            sink._parallel_hasher._min_chunk_size = 1000
+            with open(TEST_FILE, 'rb') as fh:
+                while True:
+                    data = fh.read(701)
+                    if not data:
+                        break
+                    sink.write(bytearray(data))
+            sums = sink.get_checksums()
+        self.assertEqual(sorted(sums.keys()), sorted(TEST_FILE_CHECKSUMS.keys()))
+        self.check_sums(sums)
+
+    def test_crc32c_combine(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 2000)))
+            split = rng.randint(0, len(data))
+            head, tail = CRC32C(data[:split]), CRC32C(data[split:])
+            head.combine(tail.get_state()['crc'], len(data) - split)
+            self.assertEqual(head.hexdigest(), CRC32C(data).hexdigest())
+        self.assertEqual(crc32c_combine(0x1234, 0, 0), 0x1234)
+
+    def test_resume_from_checkpoint(self):
+        with open(TEST_FILE, 'rb') as fh:
+            data = fh.read()
+        for hash_functions, resume_offset in ((('crc32c', 's3_etag'), 20000), (('crc32c', 'sha256'), 0)):
+            sink = ChecksummingSink(10000, hash_functions=hash_functions)
+            for i in range(0, 25000, 1000):
+                sink.write(data[i:i + 1000])
+            checkpoint = json.loads(json.dumps(sink.checkpoint()))
+            resumed = ChecksummingSink.resume(checkpoint)
+            self.assertEqual(resumed.offset, resume_offset)
+            for i in range(resumed.offset, len(data), 3000):
+                resumed.write(data[i:i + 3000])
+            expected = ChecksummingSink(10000, hash_functions=hash_functions)
+            expected.write(data)
+            self.assertEqual(resumed.get_checksums(), expected.get_checksums())
+
+            # Checkpoints of a resumed sink taken before it has caught up with the first checkpoint
+            resumed = ChecksummingSink.resume(checkpoint)
+            resumed.write(data[resumed.offset:resumed.offset + 50])
+            resumed = ChecksummingSink.resume(json.loads(json.dumps(resumed.checkpoint())))
+            self.assertEqual(resumed.offset, resume_offset)
+            for i in range(resumed.offset, len(data), 3000):
+                resumed.write(data[i:i + 3000])
+            self.assertEqual(resumed.get_checksums(), expected.get_checksums())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))  # noqa
+sys.path.insert(0, pkg_root)  # noqa
+
+from dcplib.checksumming_io import checksum_tree
+from dcplib.checksumming_io import checksumming_tree
+from . import TEST_FILE, TEST_FILE_CHECKSUMS
+
+
+class TestChecksumTree(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.root, 'cache', 'checksums.sqlite')
+        self.tree = os.path.join(self.root, 'tree')
+        os.makedirs(os.path.join(self.tree, 'a', 'b'))
+        self.paths = []
+        for i, dirname in enumerate(['', 'a', os.path.join('a', 'b')] * 3):
+            path = os.path.join(self.tree, dirname, 'file{}.json'.format(i))
+            shutil.copyfile(TEST_FILE, path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def scan(self, **kwargs):
+        with mock.patch.object(checksumming_tree, 'checksum_file', wraps=checksumming_tree.checksum_file) as cf:
+            results = dict(checksum_tree(self.tree, workers=2, cache_path=self.cache_path, **kwargs))
+        return results, cf.call_count
+
+    def test_checksum_tree_uses_cache_for_unchanged_files(self):
+        results, checksummed = self.scan()
+        self.assertEqual(sorted(results), sorted(self.paths))
+        self.assertEqual(checksummed, len(self.paths))
+        for checksums in results.values():
+            self.assertEqual(checksums, TEST_FILE_CHECKSUMS)
+
+        results, checksummed = self.scan()
+        self.assertEqual(checksummed, 0)
+        self.assertEqual(len(results), len(self.paths))
+
+        with open(self.paths[4], 'ab') as fh:
+            fh.write(b'\n')
+        os.utime(self.paths[4], ns=(0, 0))
+        results, checksummed = self.scan(hash_functions=['sha1'])
+        self.assertEqual(checksummed, 1)
+        self.assertEqual(results[self.paths[0]], {'sha1': TEST_FILE_CHECKSUMS['sha1']})
+        self.assertNotEqual(results[self.paths[4]]['sha1'], TEST_FILE_CHECKSUMS['sha1'])
+
+    def test_concurrent_scans_share_cache(self):
+        scan = checksum_tree(self.tree, workers=1, cache_path=self.cache_path)
+        first = dict([next(scan), next(scan)])
+        results, checksummed = self.scan()
+        self.assertEqual(sorted(results), sorted(self.paths))
+        first.update(scan)
+        self.assertEqual(first, results)
+
+    def test_cache_inside_tree_is_not_checksummed(self):
+        self.cache_path = os.path.join(self.tree, 'checksums.sqlite')
+        results, checksummed = self.scan()
+        self.assertEqual(sorted(results), sorted(self.paths))
+
+
+if __name__ == '__main__':
+    unittest.main()
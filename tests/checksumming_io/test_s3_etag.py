@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))  # noqa
+sys.path.insert(0, pkg_root)  # noqa
+
+from dcplib.checksumming_io import S3Etag, compute_s3_etag
+from . import TEST_FILE, TEST_FILE_CHECKSUMS
+
+
+def reference_etag(data, chunk_size):
+    parts = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    if len(parts) <= 1:
+        return hashlib.md5(data).hexdigest()
+    digests = b"".join(hashlib.md5(part).digest() for part in parts)
+    return '{}-{}'.format(hashlib.md5(digests).hexdigest(), len(parts))
+
+
+class TestS3Etag(unittest.TestCase):
+
+    def test_random_write_patterns_match_reference_etag(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            chunk_size = rng.randint(1, 64)
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 8 * chunk_size)))
+            etag = S3Etag(chunk_size)
+            offset = 0
+            while offset < len(data):
+                # Writes range from a single byte to several parts, in any of the buffer types callers pass.
+                size = rng.choice([1, chunk_size, rng.randint(1, 5 * chunk_size)])
+                buffer_type = rng.choice([bytes, bytearray, memoryview])
+                etag.update(buffer_type(data[offset:offset + size]))
+                offset += size
+            self.assertEqual(etag.hexdigest(), reference_etag(data, chunk_size), (chunk_size, len(data)))
+
+    def test_hexdigest_does_not_finish_the_current_part(self):
+        etag = S3Etag(4)
+        etag.update(b"abcdef")
+        self.assertEqual(etag.hexdigest(), reference_etag(b"abcdef", 4))
+        etag.update(b"gh")
+        self.assertEqual(etag.hexdigest(), reference_etag(b"abcdefgh", 4))
+        self.assertEqual(etag.hexdigest(), reference_etag(b"abcdefgh", 4))
+
+    def test_large_writes_are_not_copied(self):
+        chunk_size = 1024 * 1024
+        data = os.urandom(16 * chunk_size + 1)
+        etag = S3Etag(chunk_size)
+        tracemalloc.start()
+        try:
+            etag.update(data)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, chunk_size // 16)
+        self.assertEqual(etag.hexdigest(), reference_etag(data, chunk_size))
+
+    def test_compute_s3_etag(self):
+        self.assertEqual(compute_s3_etag(TEST_FILE, workers=2), TEST_FILE_CHECKSUMS['s3_etag'])
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "data")
+            for size in (0, 1, 1000, 1001, 4567):
+                with open(path, "wb") as fh:
+                    fh.write(os.urandom(size))
+                with open(path, "rb") as fh:
+                    expected = reference_etag(fh.read(), 1000)
+                self.assertEqual(compute_s3_etag(path, workers=3, chunk_size=1000), expected)
+            self.assertEqual(compute_s3_etag(path, workers=2, chunk_size=1000, executor_class=ProcessPoolExecutor),
+                             expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import tempfile
-import unittest, io, os, sys, json, logging, concurrent.futures, shutil
+import unittest, io, os, sys, json, logging, concurrent.futures, shutil, hashlib, threading, http.server, urllib.parse
+import functools
+import socketserver
+import time
 from collections import defaultdict
 
 import requests
@@ -43,7 +46,8 @@ def error_fn(*args, **kwargs):
 
 
 files = [
-    {"name": hex(i), "content-type": "application/json", "uuid": hex(i), "version": "1", "sha256": "0"}
+    {"name": hex(i), "content-type": "application/json", "uuid": hex(i), "version": "1",
+     "sha256": hashlib.sha256(b"{}").hexdigest()}
     for i in range(256)
 ]
 
@@ -51,7 +55,7 @@ files = [
 class MockHTTPClient:
     status_code = requests.codes.ok
 
-    def get(self, url, params):
+    def get(self, url, params, stream=False):
         if "files" in url:
             payload = {}
         else:
@@ -77,10 +81,116 @@ class MockDSSClient(MockHTTPClient):
             for i in range(4):
                 yield {"results": [{"bundle_fqid": "a{0}.{1}.b".format(i, j)} for j in range(per_page)]}
 
+    class MockGetBundlesAll:
+        def __init__(self):
+            self.bundles = []
+
+        def iterate(self, replica, per_page, prefix):
+            for bundle in self.bundles:
+                if bundle["uuid"].startswith(prefix):
+                    yield bundle
+
     post_search = MockDSSMethod()
 
     def __init__(self, swagger_url="swagger_url"):
         self.swagger_url = swagger_url
+        self.get_bundles_all = self.MockGetBundlesAll()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer was added in Python 3.7
+    daemon_threads = True
+
+
+class MockDSSServer(threading.Thread):
+    """
+    A local HTTP stand-in for the DSS bundle, file and checkout endpoints. File requests are redirected once with a
+    Retry-After header, as DSS does while it prepares a file. Checkouts are reported as running once before they
+    succeed, and checked out files are served from /checkout/, with support for Range requests. Requests for the paths
+    in throttled are answered with 429 and a Retry-After header as many times as given.
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.requests = defaultdict(int)
+        self.ranges = []
+        self.manifest_files = files
+        self.throttled = {}
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                server.requests[url.path] += 1
+                if server.throttled.get(url.path):
+                    server.throttled[url.path] -= 1
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                elif url.path.startswith("/bundles/checkout/"):
+                    bundle_uuid = url.path.split("/")[-1]
+                    if server.requests[url.path] == 1:
+                        self.send_json({"status": "RUNNING"})
+                    else:
+                        location = "{}/checkout/{}".format(server.url, bundle_uuid)
+                        self.send_json({"status": "SUCCEEDED", "location": location})
+                elif url.path.startswith("/checkout/"):
+                    body = b"{}"
+                    if "Range" in self.headers:
+                        first, last = map(int, self.headers["Range"][len("bytes="):].split("-"))
+                        server.ranges.append(self.headers["Range"])
+                        self.send_body(body[first:last + 1], status=206)
+                    else:
+                        self.send_body(body)
+                elif url.path.startswith("/bundles/"):
+                    self.send_json({"bundle": {"files": server.manifest_files}})
+                elif url.path.startswith("/files/") and "redirected" not in url.query:
+                    self.send_response(301)
+                    self.send_header("Location", "{}&redirected=1".format(self.path))
+                    self.send_header("Retry-After", "0")
+                    self.end_headers()
+                elif url.path.startswith("/files/"):
+                    self.send_json({})
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def do_POST(self):
+                url = urllib.parse.urlsplit(self.path)
+                server.requests[url.path] += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if url.path.startswith("/bundles/") and url.path.endswith("/checkout"):
+                    self.send_json({"checkout_job_id": url.path.split("/")[2]})
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def send_json(self, payload):
+                self.send_body(json.dumps(payload).encode())
+
+            def send_body(self, body, status=200):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("localhost", 0), Handler)
+        self.url = "http://localhost:{}".format(self.httpd.server_port)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
 
 class TestETL(unittest.TestCase):
@@ -215,6 +325,800 @@ class TestETL(unittest.TestCase):
         self.assertEqual(calls["ld"], 0)
         self.assertEqual(calls["fn"], 1)
 
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_file_filter_patterns(self):
+        import fnmatch
+        import dcplib.etl
+        patterns = ['application/json; dcp-type="metadata*"', "*.fastq.gz", "a?c", "[!x]yz", "lit.eral"]
+        names = ['application/json; dcp-type="metadata/biomaterial"', 'application/json; dcp-type="data"',
+                 "r1.fastq.gz", "r1.fastq.gzip", "abc", "ac", "xyz", "ayz", "lit.eral", "litXeral", "",
+                 "line\nbreak.fastq.gz"]
+        regex = dcplib.etl.compile_patterns(patterns)
+        for name in names:
+            self.assertEqual(bool(regex.match(name)), any(fnmatch.fnmatchcase(name, p) for p in patterns), name)
+        self.assertIsNone(dcplib.etl.compile_patterns([]).match(""))
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td, dss_client=MockDSSClient(), http_client=MockHTTPClient())
+            self.assertTrue(e._should_fetch_file({"content-type": names[0], "name": "x"}))
+            self.assertFalse(e._should_fetch_file({"content-type": names[1], "name": "r1.fastq.gz"}))
+            e.filename_patterns = ["*.fastq.gz"]
+            self.assertTrue(e._should_fetch_file({"content-type": names[1], "name": "r1.fastq.gz"}))
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_get_file_streams_to_staging_directory(self):
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient(),
+                                        download_chunk_size=1)
+            os.makedirs(os.path.join(td, "bundles", "a.b"))
+            os.makedirs(os.path.join(td, "files"))
+            e.get_file(files[0], "a", "b", print_progress=False)
+            self.assertEqual(os.listdir(os.path.join(td, "files")), ["0x0.1"])
+            with open(os.path.join(td, "bundles", "a.b", "0x0")) as fh:
+                self.assertEqual(json.load(fh), {})
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_shared_file_fetch_pool(self):
+        import dcplib.etl
+
+        class RecordingHTTPClient(MockHTTPClient):
+            def __init__(self):
+                self.fetch_threads = set()
+
+            def get(self, url, params, stream=False):
+                if "files" in url:
+                    self.fetch_threads.add(threading.current_thread().name)
+                return super().get(url, params, stream=stream)
+
+        with tempfile.TemporaryDirectory() as td:
+            http_client = RecordingHTTPClient()
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=http_client,
+                                        max_file_fetch_workers=4)
+            _, _, fetched_files = e.get_files_to_fetch_for_bundle("a", "b")
+            self.assertEqual(len(fetched_files), len(files))
+            self.assertEqual(len(os.listdir(os.path.join(td, "bundles", "a.b"))), len(files))
+            self.assertTrue(all(name.startswith("fetch") for name in http_client.fetch_threads))
+            self.assertLessEqual(len(http_client.fetch_threads), 4)
+            self.assertEqual(e.get_files_to_fetch_for_bundle("a", "b")[2], [])
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient(),
+                                        max_file_fetch_workers=4)
+            stats = e.extract(query={"test": True}, max_workers=2, page_size=1, transformer=tf,
+                              dispatch_executor_class=concurrent.futures.ProcessPoolExecutor)
+            self.assertEqual(stats["extracted_bundles"], 4)
+            self.assertIsNone(e._fetch_executor)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_paged_manifest_files_are_fetched_as_pages_arrive(self):
+        import dcplib.etl
+
+        class PagedHTTPClient(MockHTTPClient):
+            def __init__(self):
+                self.requests = []
+
+            def get(self, url, params, stream=False):
+                self.requests.append(url)
+                if "files" in url:
+                    return super().get(url, params, stream=stream)
+                page = 2 if url.endswith("page=2") else 1
+                res = Response()
+                res.status_code = requests.codes.ok
+                res.raw = io.BytesIO(json.dumps({"bundle": {"files": files[:2] if page == 1 else files[2:4]}}).encode())
+                if page == 1:
+                    res.headers["Link"] = '<http://localhost/bundles/a?page=2>; rel="next"'
+                return res
+
+        with tempfile.TemporaryDirectory() as td:
+            http_client = PagedHTTPClient()
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=http_client)
+            _, _, fetched_files = e.get_files_to_fetch_for_bundle("a", "b")
+            self.assertEqual(fetched_files, files[:4])
+            self.assertEqual(http_client.requests, ["localhost/bundles/a", "localhost/files/0x0",
+                                                    "localhost/files/0x1", "http://localhost/bundles/a?page=2",
+                                                    "localhost/files/0x2", "localhost/files/0x3"])
+            self.assertEqual(e.staging.load_manifest("a", "b")["files"], files[:4])
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_get_file_verifies_checksum(self):
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            os.makedirs(os.path.join(td, "bundles", "a.b"))
+            os.makedirs(os.path.join(td, "files"))
+            with self.assertRaises(dcplib.etl.ChecksumMismatch):
+                e.get_file(dict(files[0], sha256="0"), "a", "b", print_progress=False)
+            self.assertEqual(os.listdir(os.path.join(td, "files")), [])
+
+        class FailingHTTPClient(MockHTTPClient):
+            status_code = requests.codes.server_error
+
+            def get(self, url, params, stream=False):
+                self.res = super().get(url, params, stream=stream)
+                return self.res
+
+        with tempfile.TemporaryDirectory() as td:
+            http_client = FailingHTTPClient()
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        dss_client=MockDSSClient(),
+                                        http_client=http_client)
+            with self.assertRaises(requests.exceptions.HTTPError):
+                e.get_file(files[0], "a", "b", print_progress=False)
+            self.assertTrue(http_client.res.raw.closed)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_cached_files_are_trusted_until_changed(self):
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            _, _, fetched_files = e.get_files_to_fetch_for_bundle("a", "b")
+            self.assertEqual(len(fetched_files), len(files))
+            _, _, fetched_files = e.get_files_to_fetch_for_bundle("a", "b")
+            self.assertEqual(len(fetched_files), 0)
+            with open(os.path.join(td, "files", "0x0.1"), "w") as fh:
+                fh.write("corrupt")
+            _, _, fetched_files = e.get_files_to_fetch_for_bundle("a", "b")
+            self.assertEqual(fetched_files, [files[0]])
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_content_addressed_staging_area(self):
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient(),
+                                        staging_area_class=dcplib.etl.ContentAddressedStagingArea)
+            e.extract(query={"test": True}, max_workers=2, transformer=tf, loader=ld, finalizer=fn, page_size=1)
+            # All files in the mock bundles have identical content, so a single file blob is stored
+            blob = files[0]["sha256"]
+            self.assertEqual(os.listdir(os.path.join(td, "blobs", blob[:2])), [blob])
+            self.assertFalse(os.path.exists(os.path.join(td, "files")))
+            self.assertEqual(os.path.realpath(os.path.join(td, "bundles", "a0.0.b", "0x1")),
+                             os.path.realpath(os.path.join(td, "blobs", blob[:2], blob)))
+            # Manifests are stored in the staging database, and written out when their path is requested.
+            self.assertEqual(e.staging.load_manifest("a0", "0.b")["files"], files)
+            with open(e.staging.manifest_path("a0", "0.b")) as fh:
+                self.assertEqual(json.load(fh)["files"], files)
+        self.assertEqual(calls["tf"], 4)
+        self.assertEqual(calls["ld"], 4)
+
+        documents = []
+
+        def view_tf(bundle_uuid, bundle_version, bundle_path, bundle_manifest_path, extractor):
+            self.assertIsNone(bundle_path)
+            self.assertIsNone(bundle_manifest_path)
+            with extractor.bundle_view(bundle_uuid, bundle_version) as bundle:
+                self.assertEqual(len(bundle), len(files))
+                documents.append(bundle.json("0x1"))
+
+        with tempfile.TemporaryDirectory() as td:
+            staging_area_class = functools.partial(dcplib.etl.ContentAddressedStagingArea, bundle_directories=False)
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient(),
+                                        staging_area_class=staging_area_class,
+                                        cache_max_bundles=2)
+            e.extract(query={"test": True}, max_workers=1, max_bundles_in_flight=1, transformer=view_tf,
+                      page_size=1)
+            self.assertEqual(documents, [{}] * 4)
+            # No file or directory is created per bundle.
+            self.assertEqual(sorted(name for name in os.listdir(td) if not name.startswith("staging.db")),
+                             ["blobs"])
+            # Evicted bundles are forgotten, but their files are still used by the remaining bundles.
+            self.assertEqual(e.staging.staged_files("a0", "0.b"), {})
+            self.assertEqual(len(e.staging.staged_files("a3", "0.b")), len(files))
+            self.assertTrue(os.path.exists(os.path.join(td, "blobs", blob[:2], blob)))
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_async_extractor(self):
+        from dcplib.etl.async_extractor import AsyncDSSExtractor
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td, MockDSSServer() as server:
+            dss_client = MockDSSClient()
+            dss_client.host = server.url
+            e = AsyncDSSExtractor(staging_directory=td,
+                                  content_type_patterns=["application/json"],
+                                  dss_client=dss_client)
+            loader_threads = set()
+
+            def loader(**kwargs):
+                loader_threads.add(threading.current_thread())
+                ld(**kwargs)
+
+            e.extract(query={"test": True}, max_connections=4, max_bundles_in_flight=1, transformer=tf, loader=loader,
+                      finalizer=fn, page_processor=pp, page_size=1)
+            # Loaders run on an executor, not on the event loop's thread.
+            self.assertNotIn(threading.current_thread(), loader_threads)
+            self.assertEqual(len(os.listdir(os.path.join(td, "bundles", "a0.0.b"))), len(files))
+            self.assertEqual(server.requests["/bundles/a0"], 1)
+            # One request redirected with Retry-After, one following the redirect. Files fetched for the first bundle
+            # are reused from the staging area by later bundles, which are extracted one at a time.
+            self.assertEqual(server.requests["/files/0x0"], 2)
+        self.assertEqual(calls["tf"], 4)
+        self.assertEqual(calls["ld"], 4)
+        self.assertEqual(calls["pp"], 4)
+        self.assertEqual(calls["fn"], 1)
+
+        with tempfile.TemporaryDirectory() as td, MockDSSServer() as server:
+            dss_client = MockDSSClient()
+            dss_client.host = server.url
+            e = AsyncDSSExtractor(staging_directory=td,
+                                  content_type_patterns=["application/json"],
+                                  dss_client=dss_client,
+                                  continue_on_bundle_extract_errors=True)
+            e.max_retries = 0
+            server.throttled["/bundles/a1"] = 1
+            stats = e.extract(query={"test": True}, max_connections=4, transformer=tf, page_size=1)
+            self.assertEqual(stats["extracted_bundles"], 3)
+            self.assertEqual(stats["failed_bundles"], 1)
+            self.assertEqual(list(e.errors.failed_bundles()), [("a1", "0.b")])
+            self.assertEqual([(error["stage"], error["http_status"]) for error in e.errors.errors()],
+                             [("manifest", 429), ("extract_transform", 429)])
+            stats = e.retry_failed(max_connections=4, transformer=tf, page_size=1)
+            self.assertEqual(stats["total_bundles"], 1)
+            self.assertEqual(stats["extracted_bundles"], 1)
+            self.assertEqual(list(e.errors.failed_bundles()), [])
+            self.assertEqual(len(list(e.journal.bundles(e.journal.LOADED))), 4)
+            stats = e.extract(query={"test": True}, max_connections=4, transformer=tf, page_size=1, resume=True)
+            self.assertEqual(stats["extracted_bundles"], 0)
+            # Bundles of later pages are extracted while those of earlier pages are still being transformed.
+            barrier, pages = threading.Barrier(2, timeout=10), []
+
+            def barrier_tf(bundle_uuid, **kwargs):
+                barrier.wait()
+                return bundle_uuid
+
+            stats = e.extract(query={"test": True}, max_connections=4, max_bundles_in_flight=2,
+                              transformer=barrier_tf, page_processor=pages.append, page_size=1)
+            self.assertEqual(stats["extracted_bundles"], 4)
+            self.assertEqual(pages, [["a0"], ["a1"], ["a2"], ["a3"]])
+
+            # Listings of all bundles become the baseline for incremental extractions once the extraction completes.
+            dss_client.get_bundles_all.bundles = [{"uuid": "00a", "version": "1"}, {"uuid": "ffa", "version": "1"}]
+            stats = e.extract(max_connections=4, transformer=tf)
+            self.assertEqual(stats["extracted_bundles"], 2)
+            bundle_lists = os.listdir(os.path.join(td, "bundle_list"))
+            self.assertTrue({"00.jsonl", "ff.jsonl"} <= set(bundle_lists))
+            self.assertFalse(any(name.endswith(".next") for name in bundle_lists))
+        calls["tf"] = 0
+        with tempfile.TemporaryDirectory() as td:
+            dss_client = MockDSSClient()
+            dss_client.get_bundles_all.bundles = [{"uuid": "00a", "version": "1"}]
+            e = dcplib.etl.DSSExtractor(staging_directory=td, dss_client=dss_client, http_client=MockHTTPClient())
+            self.assertEqual(e.count_bundles(), 1)
+            self.assertEqual(list(e.list_all_bundles()), dss_client.get_bundles_all.bundles)
+            self.assertFalse(any(name.endswith(".next") for name in os.listdir(os.path.join(td, "bundle_list"))))
+            e.extract(max_workers=2, transformer=tf, incremental=True)
+            self.assertEqual(calls["tf"], 0)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_bundle_checkout(self):
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td, MockDSSServer() as server:
+            dss_client = MockDSSClient()
+            dss_client.host = server.url
+            server.manifest_files = [dict(files[0], size=2)] + files[1:]
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["none"],
+                                        filename_patterns=["0x0", "0x1"],
+                                        dss_client=dss_client,
+                                        max_file_fetch_workers=4,
+                                        bundle_checkout=True,
+                                        checkout_range_size=1)
+            e.checkout_poll_interval = 0
+            # The first file is fetched in two ranges of one byte; the second file's size is unknown.
+            e.get_files_to_fetch_for_bundle("a0", "1")
+            bundle_dir = os.path.join(td, "bundles", "a0.1")
+            with open(os.path.join(bundle_dir, "0x0")) as fh, open(os.path.join(bundle_dir, "0x1")) as fh2:
+                self.assertEqual(json.load(fh), {})
+                self.assertEqual(json.load(fh2), {})
+            self.assertEqual(server.requests["/bundles/a0/checkout"], 1)
+            self.assertEqual(server.requests["/bundles/checkout/a0"], 2)
+            self.assertEqual(server.requests["/files/0x0"], 0)
+            self.assertEqual(sorted(server.ranges), ["bytes=0-0", "bytes=1-1"])
+            self.assertEqual(server.requests["/checkout/a0/0x1"], 1)
+            # Bundles whose files are all staged already are not checked out.
+            e.get_files_to_fetch_for_bundle("a1", "1")
+            self.assertEqual(server.requests["/bundles/a1/checkout"], 0)
+            self.assertEqual(len(os.listdir(os.path.join(td, "bundles", "a1.1"))), 2)
+        self.assertEqual(dcplib.etl.DSSExtractor.checkout_file_url("s3://bucket/bundles/a.1", {"name": "x y"}),
+                         "https://bucket.s3.amazonaws.com/bundles/a.1/x%20y")
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_metrics(self):
+        import dcplib.etl
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            snapshots = []
+            status_file = os.path.join(td, "status.json")
+            e.extract(query={"test": True}, max_workers=1, page_size=1, transformer=tf, loader=ld,
+                      metrics_callback=snapshots.append, status_file=status_file, status_interval=0)
+            self.assertGreater(len(snapshots), 1)
+            counters = snapshots[-1]["counters"]
+            self.assertEqual(counters["bundles_extracted"], 4)
+            self.assertEqual(counters["manifests_fetched"], 4)
+            self.assertEqual(counters["files_fetched"], len(files))
+            self.assertEqual(counters["bytes_fetched"], 2 * len(files))
+            self.assertEqual(counters["file_cache_hits"], 3 * len(files))
+            stages = snapshots[-1]["stages"]
+            self.assertEqual(stages["transform"]["count"], 4)
+            self.assertEqual(stages["load"]["count"], 4)
+            self.assertEqual(stages["file_fetch"]["count"], len(files))
+            self.assertEqual(sum(stages["manifest_fetch"]["histogram"].values()), 4)
+            self.assertGreater(snapshots[-1]["rates"]["bundles_per_second"], 0)
+            with open(status_file) as fh:
+                self.assertEqual(json.load(fh)["counters"], counters)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_staging_cache_eviction(self):
+        import dcplib.etl
+        from dcplib.etl.cache import StagingCache
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient(),
+                                        cache_max_bundles=2)
+            e.extract(query={"test": True}, max_workers=1, max_bundles_in_flight=1, page_size=1, transformer=tf)
+            self.assertEqual(sorted(os.listdir(os.path.join(td, "bundles"))), ["a2.0.b", "a3.0.b"])
+            self.assertEqual(sorted(os.listdir(os.path.join(td, "bundle_manifests"))), ["a2.0.b.json", "a3.0.b.json"])
+            # Files are shared by the remaining bundles, so none are evicted and no links are left dangling.
+            self.assertEqual(len(os.listdir(os.path.join(td, "files"))), len(files))
+            bundle_dir = os.path.join(td, "bundles", "a3.0.b")
+            self.assertTrue(all(os.path.exists(os.path.join(bundle_dir, name)) for name in os.listdir(bundle_dir)))
+
+        for policy, evicted in (StagingCache.LRU, [("b", "1")]), (StagingCache.LFU, [("a", "1")]):
+            with tempfile.TemporaryDirectory() as td:
+                staging = dcplib.etl.StagingArea(td)
+                cache = StagingCache(staging, max_bytes=6, policy=policy)
+                # Candidates are read one at a time, past the pinned and other shards' bundles.
+                cache.eviction_batch_size = 1
+                shared, own_a, own_b, own_c = [dict(files[i], size=2) for i in range(4)]
+                for bundle_uuid, bundle_files in ("a", [shared, own_a]), ("b", [shared, own_b]), ("c", [own_c]):
+                    cache.touch(bundle_uuid, "1")
+                    for f in bundle_files:
+                        cache.add_file(bundle_uuid, "1", staging.file_path(f), f["size"])
+                        os.makedirs(os.path.join(td, "files"), exist_ok=True)
+                        with open(staging.file_path(f), "w") as fh:
+                            fh.write("{}")
+                        staging.link_file(bundle_uuid, "1", f)
+                for bundle_uuid in "b", "b", "a":
+                    cache.touch(bundle_uuid, "1")
+                self.assertEqual(cache.totals(), (8, 3))
+                # Another shard, which only knows its own pinned bundles, does not evict bundles of this one.
+                self.assertEqual(cache.evict(pinned={("b", "1")}, shard_index=1, shard_count=2), [])
+                # a is the most recently used bundle, and b the most frequently used one; c is pinned.
+                self.assertEqual(cache.evict(pinned={("c", "1")}), evicted)
+                self.assertEqual(cache.totals(), (6, 2))
+                self.assertTrue(os.path.exists(staging.file_path(shared)))
+                self.assertTrue(os.path.exists(staging.file_path(own_c)))
+                self.assertEqual(os.path.exists(staging.file_path(own_a)), evicted != [("a", "1")])
+                self.assertFalse(os.path.exists(staging.bundle_path(*evicted[0])))
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_bundle_view(self):
+        import dcplib.etl
+        documents = []
+
+        def view_tf(bundle_uuid, bundle_version, extractor, **kwargs):
+            with extractor.bundle_view(bundle_uuid, bundle_version) as bundle:
+                self.assertEqual(len(bundle), len(files))
+                self.assertIn("0x0", bundle)
+                self.assertEqual(bytes(bundle.buffer("0x1")), b"{}")
+                documents.append(bundle.json("0x0"))
+                documents.append(bundle.json("0x1"))
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            e.extract(query={"test": True}, max_workers=1, page_size=1, transformer=view_tf)
+            self.assertEqual(documents, [{}] * 8)
+            # All files have the same contents, so the document is parsed once and shared by all bundles.
+            self.assertEqual(e.document_cache.misses, 1)
+            self.assertTrue(all(d is documents[0] for d in documents))
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_page_processor_called_in_page_order(self):
+        import dcplib.etl
+        for max_bundles_in_flight in 1, 3, 64:
+            with tempfile.TemporaryDirectory() as td:
+                e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                            content_type_patterns=["application/json"],
+                                            dss_client=MockDSSClient(),
+                                            http_client=MockHTTPClient())
+                pages = []
+                e.extract(query={"test": True}, max_workers=2, max_bundles_in_flight=max_bundles_in_flight,
+                          transformer=lambda bundle_uuid, **kwargs: bundle_uuid, page_processor=pages.append,
+                          page_size=5)
+            self.assertEqual(pages, [["a{}".format(i)] * 5 for i in range(4)])
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_resume_skips_loaded_bundles(self):
+        import dcplib.etl
+
+        def failing_tf(bundle_uuid, **kwargs):
+            if bundle_uuid == "a2":
+                raise TestETLException()
+            return tf(bundle_uuid=bundle_uuid, **kwargs)
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient(),
+                                        continue_on_bundle_extract_errors=True)
+            e.extract(query={"test": True}, max_workers=2, transformer=failing_tf, loader=ld, page_size=1)
+            self.assertEqual(list(e.journal.bundles(e.journal.FAILED)), [("a2", "0.b")])
+            self.assertEqual(calls["tf"], 3)
+            e.extract(query={"test": True}, max_workers=2, transformer=tf, loader=ld, page_size=1, resume=True)
+            self.assertEqual(calls["tf"], 4)
+            self.assertEqual(calls["ld"], 4)
+            self.assertEqual(len(list(e.journal.bundles(e.journal.LOADED))), 4)
+            e.extract(query={"test": True}, max_workers=2, transformer=tf, loader=ld, page_size=1)
+            self.assertEqual(calls["tf"], 8)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_error_store_and_retry_failed(self):
+        import dcplib.etl
+
+        class FailingHTTPClient(MockHTTPClient):
+            failing = True
+
+            def get(self, url, params, stream=False):
+                res = super().get(url, params, stream=stream)
+                if self.failing and url.endswith("/bundles/a2"):
+                    res.status_code = 503
+                return res
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=FailingHTTPClient(),
+                                        continue_on_bundle_extract_errors=True)
+            stats = e.extract(query={"test": True}, max_workers=2, transformer=tf, loader=ld, page_size=1)
+            self.assertEqual(stats["failed_bundles"], 1)
+            self.assertEqual(list(e.errors.failed_bundles()), [("a2", "0.b")])
+            errors = list(e.errors.errors("a2", "0.b"))
+            self.assertEqual([error["stage"] for error in errors], ["manifest", "extract_transform"])
+            self.assertEqual(errors[0]["http_status"], 503)
+            self.assertEqual(errors[0]["exception_type"], "HTTPError")
+            self.assertIn("HTTPError", errors[0]["traceback"])
+            self.assertEqual({error["retries"] for error in errors}, {0})
+
+            stats = e.retry_failed(max_workers=2, transformer=tf, loader=ld)
+            self.assertEqual(stats["total_bundles"], 1)
+            self.assertEqual({error["retries"] for error in e.errors.errors("a2", "0.b")}, {0, 1})
+
+            e._http.failing = False
+            calls["tf"] = 0
+            stats = e.retry_failed(max_workers=2, transformer=tf, loader=ld)
+            self.assertEqual((stats["total_bundles"], stats["extracted_bundles"]), (1, 1))
+            self.assertEqual(calls["tf"], 1)
+            self.assertEqual(list(e.errors.errors()), [])
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_adaptive_concurrency(self):
+        import dcplib.etl
+        from dcplib.etl.concurrency import AdaptiveConcurrencyLimiter, parse_retry_after
+        limiter = AdaptiveConcurrencyLimiter(min_limit=2, max_limit=8, initial_limit=8, latency_target=1,
+                                             decrease_interval=0)
+        limiter.observe(latency=2, status_code=200)
+        self.assertEqual(limiter.limit, 4)
+        limiter.observe(status_code=503, retry_after=30)
+        limiter.observe(status_code=429)
+        self.assertEqual((limiter.limit, limiter.throttled), (2, 2))
+        self.assertGreater(limiter.retry_delay(), 29)
+        for _ in range(6):
+            limiter.observe(latency=0.1, status_code=200)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(parse_retry_after("5"), 5)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(parse_retry_after("later"))
+
+        with tempfile.TemporaryDirectory() as td, MockDSSServer() as server:
+            dss_client = MockDSSClient()
+            dss_client.host = server.url
+            server.throttled["/bundles/a1"] = 1
+            limiter = AdaptiveConcurrencyLimiter(max_limit=4, initial_limit=4)
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["none"],
+                                        filename_patterns=["0x0"],
+                                        dss_client=dss_client,
+                                        concurrency_limiter=limiter)
+            stats = e.extract(query={"test": True}, max_workers=4, transformer=tf, page_size=1)
+            self.assertEqual(stats["extracted_bundles"], 4)
+            self.assertEqual(server.requests["/bundles/a1"], 2)
+            self.assertEqual(limiter.throttled, 1)
+            with self.assertRaises(TypeError):
+                dcplib.etl.DSSExtractor(staging_directory=td, http_client=MockHTTPClient(), concurrency_limiter=limiter)
+
+        class SlowRetryLimiter(AdaptiveConcurrencyLimiter):
+            def observe(self, latency=None, status_code=None, retry_after=None):
+                if retry_after is not None:
+                    retry_after *= 60
+                super().observe(latency=latency, status_code=status_code, retry_after=retry_after)
+
+        # A Retry-After received once every bundle has been dispatched does not delay the end of the extraction.
+        with tempfile.TemporaryDirectory() as td, MockDSSServer() as server:
+            dss_client = MockDSSClient()
+            dss_client.host = server.url
+            server.throttled["/bundles/a3"] = 1
+            limiter = SlowRetryLimiter(max_limit=4, initial_limit=4)
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["none"],
+                                        filename_patterns=["0x0"],
+                                        dss_client=dss_client,
+                                        concurrency_limiter=limiter)
+            pages = []
+            start = time.time()
+            stats = e.extract(query={"test": True}, max_workers=4, transformer=tf, page_processor=pages.append,
+                              page_size=1)
+            self.assertEqual(stats["extracted_bundles"], 4)
+            self.assertEqual(len(pages), 4)
+            self.assertGreater(limiter.retry_delay(), 30)
+            self.assertLess(time.time() - start, 30)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_incremental_extraction(self):
+        import dcplib.etl
+        transformed, deleted = [], []
+
+        def record_tf(bundle_uuid, bundle_version, **kwargs):
+            transformed.append((bundle_uuid, bundle_version))
+
+        def record_deletion(bundle_uuid, bundle_version, **kwargs):
+            deleted.append((bundle_uuid, bundle_version))
+
+        with tempfile.TemporaryDirectory() as td:
+            dss_client = MockDSSClient()
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=dss_client,
+                                        http_client=MockHTTPClient())
+            dss_client.get_bundles_all.bundles = [{"uuid": "00a", "version": "1"}, {"uuid": "ffa", "version": "1"}]
+            e.extract(max_workers=2, transformer=record_tf, deletion_handler=record_deletion, incremental=True)
+            self.assertEqual(sorted(transformed), [("00a", "1"), ("ffa", "1")])
+            self.assertEqual(deleted, [])
+            transformed.clear()
+            dss_client.get_bundles_all.bundles = [{"uuid": "00a", "version": "2"}, {"uuid": "ffa", "version": "1"}]
+            e.extract(max_workers=2, transformer=record_tf, deletion_handler=record_deletion, incremental=True)
+            self.assertEqual(transformed, [("00a", "2")])
+            self.assertEqual(deleted, [("00a", "1")])
+            with self.assertRaises(ValueError):
+                e.extract(query={"test": True}, incremental=True)
+
+            # New bundles are dispatched again until they have been loaded, whether the previous run failed...
+            def failing_tf(bundle_uuid, bundle_version, **kwargs):
+                raise TestETLException()
+
+            dss_client.get_bundles_all.bundles = [{"uuid": "00a", "version": "3"}, {"uuid": "ffa", "version": "1"}]
+            with self.assertRaises(TestETLException):
+                e.extract(max_workers=2, transformer=failing_tf, incremental=True)
+            # ...or continued past the failure
+            e._continue_on_bundle_extract_errors = True
+            e.extract(max_workers=2, transformer=failing_tf, incremental=True)
+            transformed.clear()
+            e.extract(max_workers=2, transformer=record_tf, incremental=True)
+            self.assertEqual(transformed, [("00a", "3")])
+            transformed.clear()
+            e.extract(max_workers=2, transformer=record_tf, incremental=True)
+            self.assertEqual(transformed, [])
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_listing_overlaps_extraction(self):
+        import dcplib.etl
+        ffa_transformed = threading.Event()
+
+        class SlowGetBundlesAll(MockDSSClient.MockGetBundlesAll):
+            def iterate(self, replica, per_page, prefix):
+                if prefix == "00":
+                    # Listing of this prefix only completes once a bundle listed under another prefix is transformed
+                    self.transformed_while_listing = ffa_transformed.wait(timeout=10)
+                yield from super().iterate(replica, per_page, prefix)
+
+        def record_tf(bundle_uuid, bundle_version, **kwargs):
+            if bundle_uuid == "ffa":
+                ffa_transformed.set()
+            return bundle_uuid
+
+        with tempfile.TemporaryDirectory() as td:
+            dss_client = MockDSSClient()
+            dss_client.get_bundles_all = SlowGetBundlesAll()
+            dss_client.get_bundles_all.bundles = [{"uuid": "00a", "version": "1"}, {"uuid": "ffa", "version": "1"}]
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=dss_client,
+                                        http_client=MockHTTPClient())
+            pages = []
+            stats = e.extract(max_workers=4, transformer=record_tf, page_processor=pages.append, page_size=1)
+            self.assertTrue(dss_client.get_bundles_all.transformed_while_listing)
+            self.assertEqual(pages, [["ffa"], ["00a"]])
+            self.assertEqual(stats["total_bundles"], 2)
+            self.assertEqual(len(os.listdir(os.path.join(td, "bundle_list"))), 256)
+            with open(os.path.join(td, "bundle_list", "00.jsonl")) as fh:
+                self.assertEqual(json.loads(fh.read()), {"uuid": "00a", "version": "1"})
+
+        class CountingGetBundlesAll(MockDSSClient.MockGetBundlesAll):
+            listed = 0
+
+            def iterate(self, replica, per_page, prefix):
+                for bundle in super().iterate(replica, per_page, prefix):
+                    self.listed += 1
+                    yield bundle
+
+        listed_when_transformed = []
+
+        def failing_tf(bundle_uuid, **kwargs):
+            listed_when_transformed.append(dss_client.get_bundles_all.listed)
+            if len(listed_when_transformed) == 3:
+                raise TestETLException()
+
+        # Listings wait for the extraction to catch up, and stop when it fails.
+        with tempfile.TemporaryDirectory() as td:
+            dss_client = MockDSSClient()
+            dss_client.get_bundles_all = CountingGetBundlesAll()
+            dss_client.get_bundles_all.bundles = [{"uuid": "00{:03}".format(i), "version": "1"} for i in range(100)]
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=dss_client,
+                                        http_client=MockHTTPClient())
+            start = time.time()
+            with self.assertRaises(TestETLException):
+                e.extract(max_workers=1, transformer=failing_tf, page_size=1)
+            self.assertLess(time.time() - start, 10)
+            self.assertLessEqual(max(listed_when_transformed), 10)
+            self.assertLess(dss_client.get_bundles_all.listed, 100)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_sharded_extraction(self):
+        import dcplib.etl
+        transformed = []
+
+        def record_tf(bundle_uuid, bundle_version, **kwargs):
+            transformed.append(bundle_uuid)
+
+        with tempfile.TemporaryDirectory() as td:
+            dss_client = MockDSSClient()
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=dss_client,
+                                        http_client=MockHTTPClient())
+            dss_client.get_bundles_all.bundles = [{"uuid": u, "version": "1"} for u in ("00a", "01a", "02a", "ffa")]
+            stats = e.extract(max_workers=2, transformer=record_tf, shard_index=0, shard_count=2)
+            self.assertEqual(sorted(transformed), ["00a", "02a"])
+            self.assertEqual(stats["extracted_bundles"], 2)
+            transformed.clear()
+            e.extract(max_workers=2, transformer=record_tf, shard_index=1, shard_count=2)
+            self.assertEqual(sorted(transformed), ["01a", "ffa"])
+            transformed.clear()
+            e.extract(query={"test": True}, max_workers=2, transformer=record_tf, page_size=2, shard_index=1,
+                      shard_count=2)
+            self.assertEqual(sorted(transformed), ["a1", "a1", "a3", "a3"])
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            finalized = []
+
+            def finalizer(extractor):
+                finalized.append(extractor)
+
+            stats = dcplib.etl.extract_sharded(e, shard_count=2, query={"test": True}, max_workers=2, page_size=5,
+                                               transformer=tf, loader=ld, finalizer=finalizer)
+            self.assertEqual(stats["extracted_bundles"], 20)
+            self.assertEqual(stats["failed_bundles"], 0)
+            self.assertEqual(stats["total_bundles"], 1)
+            self.assertEqual(finalized, [e])
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_staged_pipeline(self):
+        import dcplib.etl
+        lock, active, max_active = threading.Lock(), defaultdict(int), defaultdict(int)
+
+        def tracked(stage, fn):
+            def tracked_fn(*args, **kwargs):
+                with lock:
+                    active[stage] += 1
+                    max_active[stage] = max(max_active[stage], active[stage])
+                time.sleep(0.01)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    with lock:
+                        active[stage] -= 1
+            return tracked_fn
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            pages = []
+            e.extract(query={"test": True}, max_workers=4, transformer=tracked("transform", tf),
+                      loader=tracked("load", ld), finalizer=fn, page_processor=pages.append, page_size=5,
+                      max_bundles_in_flight=16, transform_workers=4, transform_queue_size=1, load_workers=4,
+                      load_queue_size=1)
+            self.assertEqual(pages, [["TEST"] * 5] * 4)
+            self.assertEqual(dict(max_active), {"transform": 1, "load": 1})
+        self.assertEqual(calls["tf"], 20)
+        self.assertEqual(calls["ld"], 20)
+        self.assertEqual(calls["fn"], 1)
+
+        with tempfile.TemporaryDirectory() as td:
+            e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                        content_type_patterns=["application/json"],
+                                        dss_client=MockDSSClient(),
+                                        http_client=MockHTTPClient())
+            e.extract(query={"test": True}, max_workers=2, transformer=tf, loader=ld, page_size=1,
+                      transform_executor_class=concurrent.futures.ProcessPoolExecutor, transform_workers=2)
+        # Transforms ran in other processes
+        self.assertEqual(calls["tf"], 20)
+        self.assertEqual(calls["ld"], 24)
+
+    @unittest.skipIf(sys.version_info < (3, 6), "Only testing under Python 3.6+")
+    def test_batch_loader(self):
+        import dcplib.etl
+        for load_workers in None, 2:
+            with tempfile.TemporaryDirectory() as td:
+                e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                            content_type_patterns=["application/json"],
+                                            dss_client=MockDSSClient(),
+                                            http_client=MockHTTPClient())
+                batches, pages = [], []
+
+                def batch_ld(bundles):
+                    batches.append(bundles)
+
+                def finalizer(extractor):
+                    self.assertEqual(sum(len(b) for b in batches), 20)
+
+                e.extract(query={"test": True}, max_workers=2, transformer=tf, batch_loader=batch_ld,
+                          finalizer=finalizer, page_processor=pages.append, batch_size=3, page_size=5,
+                          load_workers=load_workers)
+                self.assertEqual([len(b) for b in batches[:-1]], [3] * 6)
+                self.assertEqual(batches[-1], ["TEST"] * 2)
+                self.assertEqual(len(pages), 4)
+
+            with tempfile.TemporaryDirectory() as td:
+                e = dcplib.etl.DSSExtractor(staging_directory=td,
+                                            content_type_patterns=["application/json"],
+                                            dss_client=MockDSSClient(),
+                                            http_client=MockHTTPClient())
+                batches = []
+                e.extract(query={"test": True}, max_workers=1, transformer=tf, batch_loader=batch_ld,
+                          batch_size=100, batch_flush_interval=0, page_size=5, load_workers=load_workers)
+                self.assertEqual(sum(len(b) for b in batches), 20)
+                self.assertGreater(len(batches), 1)
+        with self.assertRaises(ValueError):
+            e.extract(query={"test": True}, loader=ld, batch_loader=ld)
+
 
 if __name__ == '__main__':
     unittest.main()